@@ -1,18 +1,55 @@
 import streamlit as st
 import pandas as pd
-from st_aggrid import AgGrid, GridOptionsBuilder, DataReturnMode, JsCode
-import plotly.express as px
-import os
-
-# Funciones de cálculo con fórmulas corregidas
-def calculate_total_misiones(row):
-    return round(
-        (row['Costo de Pasaje'] + (row['Alojamiento'] + row['Per-diem y Otros'] + row['Movilidad']) * row['Días']) * row['Cantidad de Funcionarios'],
-        2
-    )
-
-def calculate_total_consultorias(row):
-    return round(row['Nº'] * row['Monto mensual'] * row['cantidad meses'], 2)
+import numpy as np
+import time
+import uuid
+from contextlib import contextmanager
+from ppt_core import (
+    COUNT_COLUMNS, FORMULAS, TIPOS, UNIT_REGISTRY, SCENARIO_COLUMNS, SchemaError,
+    dpp_frame, parse_number, get_schemas, load_normalized_sheet, normalized_sheet, workbook_version,
+    sheet_view, sheet_page, start_preload, start_watcher, change_seq, changes_since, CONSOLIDADO_SHEETS,
+    save_to_cache, load_from_cache, load_versioned, cache_aggregates, consolidado_tables,
+    history_versions, table_at_version, diff_frames, excel_dpp_frame, dpp_package_xlsx,
+    STORE_DIMENSIONS, REQUERIMIENTO, DPP, sync_store_workbook, store_totals, refresh_store_dpp, cube_rollup,
+    linear_terms, solve_budget_fit, scenario_matrix, scenarios_from_tables,
+)
+from ppt_core import monto_dpp as read_monto_dpp
+import ppt_metrics as metrics
+
+# st_aggrid y plotly se importan dentro de las funciones de las páginas que los
+# usan: el arranque del proceso no los carga y el primer uso los deja en
+# sys.modules, así que en los reruns siguientes el import es una búsqueda en un
+# diccionario. openpyxl lo carga pandas al leer el libro, en el hilo de precarga.
+# ppt_bench.py --imports mide el costo de arranque y lo compara con su presupuesto.
+
+def report_coercion_failures(failures, sheet_name):
+    if failures:
+        detalle = ", ".join(f"'{col}': {n}" for col, n in failures.items())
+        st.warning(f"Hay celdas no numéricas en '{sheet_name}' que se tomaron como 0 ({detalle}).")
+
+# Tablas con formato numérico: el formato viaja como configuración de columna y
+# lo aplica el navegador, así que el servidor no formatea celda por celda y el
+# costo no crece con el tamaño de la hoja. Styler se usa solo para resaltar
+# celdas en tablas chicas, con una máscara vectorizada por columna.
+STYLER_MAX_CELLS = 1000
+ZERO_HIGHLIGHT = 'background-color: #90ee90'
+
+def printf_format(fmt):
+    # "{:,.2f}" -> "%,.2f"
+    return f"%{fmt[2:-1]}"
+
+def number_columns(formats):
+    return {col: st.column_config.NumberColumn(format=printf_format(fmt)) for col, fmt in formats.items()}
+
+def zero_mask(values):
+    return np.where(values.to_numpy() == 0, ZERO_HIGHLIGHT, '')
+
+def formatted_table(df, formats, highlight_zero=(), **kwargs):
+    if highlight_zero and df.size <= STYLER_MAX_CELLS:
+        styler = df.style.apply(zero_mask, subset=list(highlight_zero)).format(formats)
+        st.dataframe(styler, **kwargs)
+    else:
+        st.dataframe(df, column_config=number_columns(formats), **kwargs)
 
 # Configuración de la página
 st.set_page_config(page_title="Presupuesto", layout="wide")
@@ -36,214 +73,179 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-# Función para guardar datos en cache
-def save_to_cache(df, unidad, tipo):
-    cache_dir = 'cache'
-    if not os.path.exists(cache_dir):
-        os.makedirs(cache_dir)
-    cache_file = f"{cache_dir}/{unidad}_{tipo}_DPP2025.csv"
-    df.to_csv(cache_file, index=False)
-
-# Función para manejar la página de Consolidado
-def handle_consolidado_page():
-    st.header("")
-    
-    file_path = 'BDD_Ajuste.xlsx'  # Asegúrate de que la ruta es correcta
-
-    try:
-        # Leer la hoja 'consolidadoV2' primero y renombrarla a 'Resumen'
-        df_resumen = pd.read_excel(file_path, sheet_name='consolidadoV2')
-        numeric_cols_resumen = df_resumen.select_dtypes(include=['float', 'int']).columns.tolist()
-        for col in numeric_cols_resumen:
-            df_resumen[col] = pd.to_numeric(df_resumen[col], errors='coerce')
-        # Redondear a una decimal
-        df_resumen[numeric_cols_resumen] = df_resumen[numeric_cols_resumen].round(1)
-
-        # Formateador a una sola decimal
-        one_decimal_formatter = '''
-            function(params) { 
-                if (params.value == null || params.value === "") { 
-                    return ""; 
-                } 
-                var val = Number(params.value); 
-                if (isNaN(val)) {
-                    return params.value;
-                } 
-                return val.toFixed(1); 
-            }
-        '''
-
-        # Configurar AgGrid para Resumen
-        gb_resumen = GridOptionsBuilder.from_dataframe(df_resumen)
-        gb_resumen.configure_default_column(editable=False, sortable=True, filter=True, type=["numericColumn"])
-
-        for col in numeric_cols_resumen:
-            gb_resumen.configure_column(
-                col,
-                type=["numericColumn"],
-                valueFormatter=one_decimal_formatter,
-                headerStyle={'backgroundColor': '#f2f2f2', 'fontWeight': 'bold'}
-            )
-        
-        # Eliminar la paginación
-        # gb_resumen.configure_pagination(paginationAutoPageSize=True)  # Comentado o eliminado
-
-        gb_resumen.configure_side_bar()
-        grid_options_resumen = gb_resumen.build()
-
-        # Calcular la altura de la tabla Resumen
-        num_rows_resumen = len(df_resumen)
-        row_height = 35  # Altura por fila en píxeles (ajusta según tu preferencia)
-        max_height = 800  # Altura máxima para la tabla
-        calculated_height_resumen = min(row_height * num_rows_resumen + 100, max_height)  # 100 píxeles adicionales para cabecera y márgenes
-
-        # Añadir una sección con un fondo ligeramente coloreado para Resumen
-        st.markdown(
-            """
-            <div style="background-color:#FFFFFF; padding:10px; border-radius:5px;">
-                <h3>Resumen</h3>
-            </div>
-            """,
-            unsafe_allow_html=True
+# Definiciones de columnas de la grilla DPP 2025: las columnas de entrada son
+# editables y el Total se recalcula en el navegador con la fórmula de la hoja.
+MONEY_FORMATTER = "Math.round(x).toLocaleString(undefined, {minimumFractionDigits: 2, maximumFractionDigits: 2})"
+
+def dpp_column_defs(schema):
+    column_defs = [
+        (col, {'editable': True, 'type': ['numericColumn'], 'valueFormatter': MONEY_FORMATTER})
+        for col in schema.editable
+    ]
+    total_def = {'editable': False, 'type': ['numericColumn'], 'valueFormatter': MONEY_FORMATTER}
+    js = FORMULAS[schema.formula]['js']
+    if js:
+        from st_aggrid import JsCode
+        total_def['valueGetter'] = JsCode(js)
+    column_defs.append(('Total', total_def))
+    return column_defs
+
+# Opciones de AgGrid memorizadas por clave de grilla y firma de columnas: el
+# esquema, los formateadores y los JsCode no cambian entre ediciones, así que se
+# construyen una vez (con los JsCode ya serializados) y se comparten entre
+# sesiones. Cada llamada recibe una copia superficial, porque AgGrid agrega
+# claves de primer nivel como domLayout.
+def column_signature(df):
+    return tuple((str(col), str(dtype)) for col, dtype in df.dtypes.items())
+
+@st.cache_resource(show_spinner=False, max_entries=64)
+@metrics.timed('grid_options')
+def _build_grid_options(key, signature, _template, _configure):
+    from st_aggrid import GridOptionsBuilder, JsCode, walk_gridOptions
+    gb = GridOptionsBuilder.from_dataframe(_template)
+    _configure(gb, _template)
+    options = gb.build()
+    walk_gridOptions(options, lambda v: v.js_code if isinstance(v, JsCode) else v)
+    return options
+
+def grid_options_for(key, df, configure):
+    return dict(_build_grid_options(key, column_signature(df), df.iloc[:0], configure))
+
+# Formateador a una sola decimal
+ONE_DECIMAL_FORMATTER = '''
+    function(params) { 
+        if (params.value == null || params.value === "") { 
+            return ""; 
+        } 
+        var val = Number(params.value); 
+        if (isNaN(val)) {
+            return params.value;
+        } 
+        return val.toFixed(1); 
+    }
+'''
+
+def configure_consolidado_grid(gb, template):
+    # El orden y el filtro se hacen en el servidor sobre la hoja completa
+    gb.configure_default_column(editable=False, sortable=False, filter=False, type=["numericColumn"])
+    for col in template.select_dtypes(include=['float', 'int']).columns:
+        gb.configure_column(
+            col,
+            type=["numericColumn"],
+            valueFormatter=ONE_DECIMAL_FORMATTER,
+            headerStyle={'backgroundColor': '#f2f2f2', 'fontWeight': 'bold'}
         )
-        st.markdown("")
 
+    gb.configure_side_bar()
+
+def configure_dpp_grid(schema):
+    def configure(gb, template):
+        gb.configure_default_column(editable=True, groupable=True)
+        for col, column_def in dpp_column_defs(schema):
+            gb.configure_column(col, **column_def)
+        gb.configure_grid_options(domLayout='normal')
+    return configure
+
+# Grillas de Resumen y Desglose paginadas en el servidor: el navegador recibe
+# solo la página visible (con altura fija y el virtualizado de filas de AgGrid)
+# y el filtro y el orden se aplican en pandas sobre la hoja compartida.
+CONSOLIDADO_PAGE_SIZES = (50, 100, 200)
+GRID_ROW_HEIGHT = 35  # Altura por fila en píxeles
+GRID_MAX_HEIGHT = 800  # Altura máxima para la tabla
+
+def paged_grid(sheet_name, title):
+    # Añadir una sección con un fondo ligeramente coloreado para el título
+    st.markdown(
+        f"""
+        <div style="background-color:#FFFFFF; padding:10px; border-radius:5px;">
+            <h3>{title}</h3>
+        </div>
+        """,
+        unsafe_allow_html=True
+    )
+    st.markdown("")
+
+    columns = list(normalized_sheet(*workbook_version(), sheet_name)[0].columns)
+    col1, col2, col3, col4 = st.columns([3, 3, 1, 1])
+    query = col1.text_input("Buscar", key=f"{sheet_name}_query")
+    sort_by = col2.selectbox("Ordenar por", [None, *columns], format_func=lambda c: "(orden de la hoja)" if c is None else str(c),
+                             key=f"{sheet_name}_sort")
+    descending = col3.checkbox("Descendente", key=f"{sheet_name}_desc")
+    page_size = col4.selectbox("Filas", CONSOLIDADO_PAGE_SIZES, key=f"{sheet_name}_page_size")
+
+    total_rows = len(sheet_view(sheet_name, sort_by, not descending, query))
+    pages = max(1, -(-total_rows // page_size))
+    page_key = f"{sheet_name}_page"
+    if st.session_state.get(page_key, 1) > pages:
+        st.session_state[page_key] = pages
+    page = st.number_input("Página", min_value=1, max_value=pages, step=1, key=page_key)
+
+    df_page, total_rows = sheet_page(sheet_name, page - 1, page_size, sort_by, not descending, query)
+    first = (page - 1) * page_size
+    st.caption(f"Filas {min(first + 1, total_rows)}–{first + len(df_page)} de {total_rows}")
+
+    from st_aggrid import AgGrid, GridUpdateMode
+    grid_options = grid_options_for(sheet_name, df_page, configure_consolidado_grid)
+    with metrics.stage('aggrid'):
         AgGrid(
-            df_resumen,
-            gridOptions=grid_options_resumen,
-            data_return_mode=DataReturnMode.FILTERED,
-            update_mode='MODEL_CHANGED',
+            df_page,
+            gridOptions=grid_options,
+            update_mode=GridUpdateMode.NO_UPDATE,
             fit_columns_on_grid_load=True,
-            height=calculated_height_resumen,
+            height=min(GRID_ROW_HEIGHT * page_size + 100, GRID_MAX_HEIGHT),  # 100 píxeles adicionales para cabecera y márgenes
             width='100%',
             theme='balham'  # Usar el mismo tema para consistencia
         )
 
-        st.markdown("---")  # Separador horizontal
-
-        # Leer la hoja 'Consolidado' y renombrarla a 'Desglose'
-        df_desglose = pd.read_excel(file_path, sheet_name='Consolidado')
-        numeric_cols_desglose = df_desglose.select_dtypes(include=['float', 'int']).columns.tolist()
-        for col in numeric_cols_desglose:
-            df_desglose[col] = pd.to_numeric(df_desglose[col], errors='coerce')
-        # Redondear a una decimal
-        df_desglose[numeric_cols_desglose] = df_desglose[numeric_cols_desglose].round(1)
-
-        # Configurar AgGrid para Desglose
-        gb_desglose = GridOptionsBuilder.from_dataframe(df_desglose)
-        gb_desglose.configure_default_column(editable=False, sortable=True, filter=True, type=["numericColumn"])
-
-        for col in numeric_cols_desglose:
-            gb_desglose.configure_column(
-                col,
-                type=["numericColumn"],
-                valueFormatter=one_decimal_formatter,
-                headerStyle={'backgroundColor': '#f2f2f2', 'fontWeight': 'bold'}
-            )
-        
-        # Eliminar la paginación
-        # gb_desglose.configure_pagination(paginationAutoPageSize=True)  # Comentado o eliminado
-
-        gb_desglose.configure_side_bar()
-        grid_options_desglose = gb_desglose.build()
-
-        # Calcular la altura de la tabla Desglose
-        num_rows_desglose = len(df_desglose)
-        calculated_height_desglose = min(row_height * num_rows_desglose + 100, max_height)  # 100 píxeles adicionales para cabecera y márgenes
-
-        # Añadir una sección con un fondo ligeramente coloreado para Desglose
-        st.markdown(
-            """
-            <div style="background-color:#FFFFFF; padding:10px; border-radius:5px;">
-                <h3>Desglose</h3>
-            </div>
-            """,
-            unsafe_allow_html=True
-        )
-        st.markdown("")
-
-        AgGrid(
-            df_desglose,
-            gridOptions=grid_options_desglose,
-            data_return_mode=DataReturnMode.FILTERED,
-            update_mode='MODEL_CHANGED',
-            fit_columns_on_grid_load=True,
-            height=calculated_height_desglose,
-            width='100%',
-            theme='balham'  # Usar el mismo tema para consistencia
-        )
+# Función para manejar la página de Consolidado
+def handle_consolidado_page():
+    st.header("")
 
+    try:
+        # La hoja 'consolidadoV2' se muestra como 'Resumen' y 'Consolidado' como 'Desglose'
+        paged_grid('consolidadoV2', "Resumen")
+        st.markdown("---")  # Separador horizontal
+        paged_grid('Consolidado', "Desglose")
     except Exception as e:
         st.error(f"Error al leer las hojas 'Consolidado' o 'consolidadoV2': {e}")
+
+def scenario_panel():
+    if not st.toggle("Calcular escenarios", key="scenarios_enabled"):
+        return
+    st.write("Variación porcentual por columna para cada escenario:")
+    percentages = st.data_editor(
+        pd.DataFrame([{'Escenario': 'Pasajes +10%', 'Costo de Pasaje': 10.0}], columns=['Escenario', *SCENARIO_COLUMNS]),
+        num_rows="dynamic", key="scenario_percentages"
+    )
+    st.write("Per-diem por País (reemplaza el valor de la hoja):")
+    lookups = st.data_editor(
+        pd.DataFrame(columns=['Escenario', 'País', 'Per-diem']).astype({'Per-diem': float}),
+        num_rows="dynamic", key="scenario_lookups"
+    )
+    frames = [(schema, load_sheet_df(schema, use_cache=True)) for schema in get_schemas().values()]
+    matrix = scenario_matrix(frames, scenarios_from_tables(percentages, lookups))
+    for tipo in TIPOS:
+        st.subheader(f"Escenarios - {tipo}")
+        table = matrix[tipo]
+        formatted_table(table, {col: "{:,.1f}" for col in table.select_dtypes(include='number').columns})
+
 # Función para crear el consolidado dividido en Misiones y Consultorías
 def create_consolidado(deseados):
     st.header("")
-    cache_dir = 'cache'
-    unidades = ['VPO', 'VPD', 'VPE', 'VPF', 'PRE']
-    tipos = ['Misiones', 'Consultorías']
-
-    data_misiones = []
-    data_consultorias = []
-
-    for unidad in unidades:
-        for tipo in tipos:
-            row = {'Unidad Organizacional': unidad}
-            cache_file = f"{cache_dir}/{unidad}_{tipo}_DPP2025.csv"
-            if os.path.exists(cache_file):
-                df = pd.read_csv(cache_file)
-                actual = df['Total'].sum()
-                deseado = deseados[unidad][tipo]
-                ajuste = deseado - actual
-                row[f"{tipo} - Actual"] = actual
-                row[f"{tipo} - Monto DPP 2025"] = deseado
-                row[f"{tipo} - Ajuste"] = ajuste
-            else:
-                deseado = deseados[unidad][tipo]
-                row[f"{tipo} - Actual"] = 0
-                row[f"{tipo} - Monto DPP 2025"] = deseado
-                row[f"{tipo} - Ajuste"] = deseado
-            if tipo == 'Misiones':
-                data_misiones.append(row)
-            else:
-                data_consultorias.append(row)
-
-    consolidado_misiones_df = pd.DataFrame(data_misiones)
-    consolidado_consultorias_df = pd.DataFrame(data_consultorias)
-
-    def highlight_zero(val):
-        color = 'background-color: #90ee90' if val == 0 else ''
-        return color
-
-    # Formatear a una sola decimal
-    consolidado_misiones_display = consolidado_misiones_df[['Unidad Organizacional', "Misiones - Actual", "Misiones - Monto DPP 2025", "Misiones - Ajuste"]]
-    styled_misiones_df = consolidado_misiones_display.style.applymap(highlight_zero, subset=["Misiones - Ajuste"])
-    styled_misiones_df = styled_misiones_df.format(
-        "{:,.1f}", 
-        subset=[
-            "Misiones - Actual",
-            "Misiones - Monto DPP 2025",
-            "Misiones - Ajuste"
-        ]
-    )
-
-    consolidado_consultorias_display = consolidado_consultorias_df[['Unidad Organizacional', "Consultorías - Actual", "Consultorías - Monto DPP 2025", "Consultorías - Ajuste"]]
-    styled_consultorias_df = consolidado_consultorias_display.style.applymap(highlight_zero, subset=["Consultorías - Ajuste"])
-    styled_consultorias_df = styled_consultorias_df.format(
-        "{:,.1f}", 
-        subset=[
-            "Consultorías - Actual",
-            "Consultorías - Monto DPP 2025",
-            "Consultorías - Ajuste"
-        ]
-    )
+    tables = consolidado_tables(deseados, cache_aggregates(list(UNIT_REGISTRY), list(TIPOS)))
+    for tipo in TIPOS:
+        amounts = [f"{tipo} - Actual", f"{tipo} - Monto DPP 2025", f"{tipo} - Ajuste"]
+        st.subheader(tipo)
+        formatted_table(tables[tipo][['Unidad Organizacional', *amounts]], dict.fromkeys(amounts, "{:,.1f}"),
+                        highlight_zero=[f"{tipo} - Ajuste"])
 
-    st.subheader("Misiones")
-    st.dataframe(styled_misiones_df)
+    package_download()
 
-    st.subheader("Consultorías")
-    st.dataframe(styled_consultorias_df)
+    st.markdown("---")
+    scenario_panel()
 
 def crear_dona(df, nombres, valores, titulo, color_map, hole=0.5, height=300, margin_l=50):
+    import plotly.express as px
     fig = px.pie(
         df,
         names=nombres,
@@ -267,584 +269,534 @@ def crear_dona(df, nombres, valores, titulo, color_map, hole=0.5, height=300, ma
     )
     return fig
 
-def main():
-    st.sidebar.title("Navegación")
-    main_page = st.sidebar.selectbox(
-        "Selecciona una página principal:",
-        ("VPO", "VPD", "VPE", "VPF", "PRE", "Coordinación", "Consolidado")
-    )
-    st.title(main_page)
-
-    deseados = {
-        "VPO": {
-            "Misiones": 434707.0,
-            "Consultorías": 547700.0
-        },
-        "VPD": {
-            "Misiones": 168000.0,
-            "Consultorías": 130000.0
-        },
-        "VPE": {
-            "Misiones": 28000.0,
-            "Consultorías": 179400.0
-        },
-        "VPF": {
-            "Misiones": 138600.0,
-            "Consultorías": 170000.0
-        },
-        "PRE": {
-            "Misiones": 0.0,
-            "Consultorías": 0.0
-        }
-    }
+# Página de análisis: totales por cualquier combinación de dimensiones leídos del
+# cubo del almacén. Los filtros bajan de nivel sobre el mismo cubo y la tabla
+# dinámica se arma en pandas sobre el resultado ya agregado, nunca sobre filas.
+ANALYSIS_SOURCES = {'DPP 2025': DPP, 'Requerimiento del área': REQUERIMIENTO}
+ANALYSIS_ALL = "(Todos)"
+NO_VALUE = "(sin valor)"
+DONUT_SLICES = 10  # el resto se agrupa en "Otros"
+
+def dimension_label(value):
+    return NO_VALUE if value is None or pd.isna(value) else value
+
+def donut_frame(totals, dim):
+    df = totals[[dim, 'total']].assign(**{dim: totals[dim].map(dimension_label)})
+    if len(df) > DONUT_SLICES:
+        others = pd.DataFrame({dim: ["Otros"], 'total': [df['total'].iloc[DONUT_SLICES:].sum()]})
+        df = pd.concat([df.iloc[:DONUT_SLICES], others], ignore_index=True)
+    return df
+
+def handle_analysis_page():
+    col1, col2 = st.columns(2)
+    source = col1.radio("Fuente", list(ANALYSIS_SOURCES), horizontal=True, key="analysis_source")
+    tipo = col2.selectbox("Tipo", [None, *TIPOS], format_func=lambda t: "Todos" if t is None else t, key="analysis_tipo")
+    fuente = ANALYSIS_SOURCES[source]
+    # Solo se recalculan los cubos de las unidades cuyo archivo cambió
+    if fuente == DPP:
+        refresh_store_dpp(list(UNIT_REGISTRY), list(TIPOS))
+    else:
+        sync_store_workbook()
+
+    dims = list(DIMENSION_LABELS)
+    filters = {}
+    with st.expander("Filtros"):
+        # Cada filtro ofrece solo los valores que quedan con los anteriores
+        for col, dim in zip(st.columns(3) * 2, dims):
+            values = cube_rollup(fuente, [dim], tipo, filters)[dim].tolist()
+            choice = col.selectbox(DIMENSION_LABELS[dim], [ANALYSIS_ALL, *values],
+                                   format_func=dimension_label, key=f"analysis_filter_{dim}")
+            if choice != ANALYSIS_ALL:
+                filters[dim] = choice
 
-    file_path = 'BDD_Ajuste.xlsx'
-    try:
-        df_pre_misiones = pd.read_excel(file_path, sheet_name='Misiones_PRE')
-        total_pre_misiones = df_pre_misiones['Total'].sum()
-        deseados["PRE"]["Misiones"] = total_pre_misiones
-    except Exception as e:
-        st.warning(f"No se pudo leer la hoja 'Misiones_PRE': {e}")
-        deseados["PRE"]["Misiones"] = 0.0
+    col1, col2 = st.columns(2)
+    rows = col1.multiselect("Filas", dims, default=['unidad'], format_func=DIMENSION_LABELS.get, key="analysis_rows")
+    column = col2.selectbox("Columnas", [None, *(dim for dim in dims if dim not in rows)],
+                            format_func=lambda d: "(ninguna)" if d is None else DIMENSION_LABELS[d], key="analysis_column")
+    by = rows + ([column] if column else [])
 
+    cube = cube_rollup(fuente, by, tipo, filters)
+    grand_total = float(cube['total'].sum())
+    col1, col2 = st.columns(2)
+    col1.metric("Total (USD)", f"{grand_total:,.2f}")
+    col2.metric("Filas", f"{int(cube['filas'].sum()):,}")
+    if cube.empty:
+        st.info("No hay datos para esta selección.")
+        return
+
+    labeled = cube.assign(**{dim: cube[dim].map(dimension_label) for dim in by})
+    if column and rows:
+        table = labeled.pivot_table(index=rows, columns=column, values='total', aggfunc='sum', fill_value=0)
+        table.columns = [str(c) for c in table.columns]
+        table = table.reset_index().rename(columns=DIMENSION_LABELS)
+        amounts = [c for c in table.columns if c not in {DIMENSION_LABELS[d] for d in rows}]
+    else:
+        table = labeled.rename(columns={**DIMENSION_LABELS, 'total': 'Total', 'filas': 'Filas'})
+        amounts = ['Total']
+    formats = {**dict.fromkeys(amounts, "{:,.2f}"), **({'Filas': "{:.0f}"} if 'Filas' in table.columns else {})}
+    formatted_table(table, formats, hide_index=True)
+
+    # Distribución por la primera dimensión elegida
+    dim = by[0] if by else None
+    if dim is not None:
+        totals = cube_rollup(fuente, [dim], tipo, filters)
+        fig = crear_dona(donut_frame(totals, dim), dim, 'total', f"Distribución por {DIMENSION_LABELS[dim]}", {})
+        st.plotly_chart(fig)
+
+def monto_dpp(unit, tipo):
     try:
-        df_pre_consultorias = pd.read_excel(file_path, sheet_name='Consultores_PRE')
-        total_pre_consultorias = df_pre_consultorias['Total'].sum()
-        deseados["PRE"]["Consultorías"] = total_pre_consultorias
+        return read_monto_dpp(unit, tipo)
     except Exception as e:
-        st.warning(f"No se pudo leer la hoja 'Consultores_PRE': {e}")
-        deseados["PRE"]["Consultorías"] = 0.0
-
-    if main_page == "VPO":
-        handle_vpo_page(deseados)
-    elif main_page == "VPD":
-        handle_vpd_page(deseados)
-    elif main_page == "VPE":
-        handle_vpe_page(deseados)
-    elif main_page == "VPF":
-        handle_vpf_page(deseados)
-    elif main_page == "PRE":
-        handle_pre_page(deseados)
-    elif main_page == "Coordinación":
-        create_consolidado(deseados)
-    elif main_page == "Consolidado":
-        handle_consolidado_page()
-
-def handle_vpo_page(deseados):
-    view = st.sidebar.selectbox("Selecciona una vista:", ("Misiones", "Consultorías"), key="VPO_view")
-
-    if view == "Misiones":
-        page = st.sidebar.selectbox("Selecciona una subpágina:", ("Requerimiento del área", "DPP 2025"), key="VPO_Misiones_page")
-        process_misiones_page("VPO", "Misiones", page, deseados, use_objetivo=True)
-    elif view == "Consultorías":
-        page = st.sidebar.selectbox("Selecciona una subpágina:", ("Requerimiento del área", "DPP 2025"), key="VPO_Consultorias_page")
-        process_consultorias_page("VPO", "Consultorías", page, deseados)
-
-def handle_vpd_page(deseados):
-    view = st.sidebar.selectbox("Selecciona una vista:", ("Misiones", "Consultorías"), key="VPD_view")
-
-    if view == "Misiones":
-        page = st.sidebar.selectbox("Selecciona una subpágina:", ("Requerimiento del área", "DPP 2025"), key="VPD_Misiones_page")
-        process_misiones_page("VPD", "Misiones", page, deseados, use_objetivo=False)
-    elif view == "Consultorías":
-        page = st.sidebar.selectbox("Selecciona una subpágina:", ("Requerimiento del área", "DPP 2025"), key="VPD_Consultorias_page")
-        process_consultorias_page("VPD", "Consultorías", page, deseados)
-
-def handle_vpf_page(deseados):
-    view = st.sidebar.selectbox("Selecciona una vista:", ("Misiones", "Consultorías"), key="VPF_view")
-
-    if view == "Misiones":
-        page = st.sidebar.selectbox("Selecciona una subpágina:", ("Requerimiento del área", "DPP 2025"), key="VPF_Misiones_page")
-        process_misiones_page("VPF", "Misiones", page, deseados, use_objetivo=False)
-    elif view == "Consultorías":
-        page = st.sidebar.selectbox("Selecciona una subpágina:", ("Requerimiento del área", "DPP 2025"), key="VPF_Consultorias_page")
-        process_consultorias_page("VPF", "Consultorías", page, deseados)
-
-def handle_pre_page(deseados):
-    view = st.sidebar.selectbox("Selecciona una vista:", ("Misiones", "Consultorías"), key="PRE_view")
-
-    if view == "Misiones":
-        page = st.sidebar.selectbox("Selecciona una subpágina:", ("Requerimiento del área", "DPP 2025"), key="PRE_Misiones_page")
-        process_misiones_page("PRE", "Misiones", page, deseados, use_objetivo=False)
-    elif view == "Consultorías":
-        page = st.sidebar.selectbox("Selecciona una subpágina:", ("Requerimiento del área", "DPP 2025"), key="PRE_Consultorias_page")
-        process_consultorias_page("PRE", "Consultorías", page, deseados)
-
-def process_misiones_page(unit, tipo, page, deseados, use_objetivo):
-    file_path = 'BDD_Ajuste.xlsx'
-    sheet_name = f"Misiones_{unit}"
-    cache_file = f'cache/{unit}_{tipo}_DPP2025.csv'
-
-    def process_misiones_df(df, sheet_name, unit):
-        if unit == "VPE":
-            required_columns = ['ÍTEM PRESUPUESTO', 'OFICINA', 'UNID. ORG.', 'ACCIONES', 'CATEGORÍA', 'SUBCATEGORÍA', 'Suma de MONTO']
-        elif unit == "PRE":
-            required_columns = ['País', 'Operación', 'PRE o VP', 'Cantidad de Funcionarios', 'Días',
-                                'Costo de Pasaje', 'Alojamiento', 'Per-diem y Otros', 'Movilidad', 'Total', 'Area imputacion']
-        else:
-            required_columns = ['País', 'Cantidad de Funcionarios', 'Días', 'Costo de Pasaje',
-                                'Alojamiento', 'Per-diem y Otros', 'Movilidad']
-            if use_objetivo:
-                required_columns.append('Objetivo')
-
-        for col in required_columns:
-            if col not in df.columns:
-                st.error(f"La columna '{col}' no existe en la hoja '{sheet_name}'.")
-                st.stop()
-
-        if unit == "VPE":
-            df['Total'] = pd.to_numeric(df['Suma de MONTO'].astype(str).str.replace(',', '').str.strip(), errors='coerce').fillna(0)
-        elif unit == "PRE":
-            df['Total'] = pd.to_numeric(df['Total'].astype(str).str.replace(',', '').str.strip(), errors='coerce').fillna(0)
+        st.warning(f"No se pudo leer la hoja '{get_schemas()[(unit, tipo)].sheet}': {e}")
+        return 0.0
+
+def build_deseados():
+    return {unit: {tipo: monto_dpp(unit, tipo) for tipo in TIPOS} for unit in UNIT_REGISTRY}
+
+# Instrumentación opcional (PPT_PROFILING=1, ver ppt_metrics): cada rerun se
+# mide completo en el histograma de la sesión y, si se pidió en el panel, se
+# captura con cProfile. Las métricas se exportan a archivo al final del rerun.
+def metrics_session():
+    if '_metrics_session' not in st.session_state:
+        st.session_state['_metrics_session'] = uuid.uuid4().hex[:8]
+    return st.session_state['_metrics_session']
+
+@contextmanager
+def measured_rerun():
+    if not metrics.enabled():
+        yield
+        return
+    profile = None
+    start = time.perf_counter()
+    try:
+        if st.session_state.get('metrics_cprofile'):
+            with metrics.profiled() as profile:
+                yield
         else:
-            numeric_columns = ['Cantidad de Funcionarios', 'Días', 'Costo de Pasaje',
-                               'Alojamiento', 'Per-diem y Otros', 'Movilidad', 'Total']
-            for col in numeric_columns:
-                if col in df.columns:
-                    df[col] = pd.to_numeric(df[col].astype(str).str.replace(',', '').str.strip(), errors='coerce').fillna(0)
-                else:
-                    st.error(f"La columna '{col}' no existe en la hoja '{sheet_name}'.")
-                    st.stop()
-
-            if 'Total' not in df.columns or df['Total'].sum() == 0:
-                df['Total'] = df.apply(calculate_total_misiones, axis=1)
-
-        return df
+            yield
+    finally:
+        metrics.observe_rerun(metrics_session(), time.perf_counter() - start)
+        if profile is not None:
+            st.session_state['_metrics_profile'] = metrics.profile_report(profile)
+        metrics.write_metrics()
+
+def metrics_panel():
+    with st.sidebar.expander("Rendimiento"):
+        data = metrics.snapshot()
+        stages = pd.DataFrame([
+            {'Etapa': name, 'Llamadas': h['count'], 'Total (s)': h['sum'], 'p50 (ms)': h['p50'] * 1000,
+             'p95 (ms)': h['p95'] * 1000, 'Máx (ms)': h['max'] * 1000}
+            for name, h in data['stages'].items()
+        ])
+        if not stages.empty:
+            st.dataframe(stages.sort_values('Total (s)', ascending=False).round(3), hide_index=True)
+        reruns = data['reruns'].get(metrics_session())
+        if reruns:
+            st.caption(f"Reruns de esta sesión: {reruns['count']} (p50 {reruns['p50'] * 1000:.0f} ms, p95 {reruns['p95'] * 1000:.0f} ms)")
+            st.bar_chart(pd.Series(reruns['buckets'], name="Reruns"))
+        if data['counters']:
+            st.write(data['counters'])
+        st.checkbox("Capturar cProfile en cada rerun", key='metrics_cprofile')
+        if st.session_state.get('_metrics_profile'):
+            st.code(st.session_state['_metrics_profile'])
+        st.download_button("Métricas (Prometheus)", metrics.to_prometheus(data), file_name="metrics.prom", mime="text/plain")
+        st.download_button("Métricas (JSON)", metrics.to_json(data), file_name="metrics.json", mime="application/json")
+        st.caption(f"Se exportan en {metrics.METRICS_FILE} tras cada rerun.")
+
+# Avisos de cambios en archivos: el vigilante del núcleo publica qué hoja o
+# tabla cambió y cada sesión recuerda el último aviso que vio. Un fragmento
+# revisa los nuevos cada WATCH_REFRESH_SECONDS y vuelve a ejecutar la app solo si
+# alguno afecta la página abierta; el rerun los muestra y los marca como vistos.
+WATCH_REFRESH_SECONDS = 2
+
+def change_affects(event, main_page):
+    if main_page == "Consolidado":
+        return event['kind'] == 'excel' and event['sheet'] in CONSOLIDADO_SHEETS
+    if main_page not in UNIT_REGISTRY:
+        return True
+    tipo = st.session_state.get(f"{main_page}_view", next(iter(TIPOS)))
+    if (event['unidad'], event['tipo']) != (main_page, tipo):
+        return False
+    if event['kind'] != 'dpp':
+        return True
+    if st.session_state.get(get_schemas()[(main_page, tipo)].page_key) != "DPP 2025":
+        return False
+    # Lo que escribió esta misma sesión ya está en su tabla
+    state = st.session_state.get(f"DPP_{main_page}_{tipo}")
+    return state is None or event['version'] is None or event['version'] > state['version']
+
+def change_label(event):
+    if event['unidad'] is None:
+        return f"hoja {event['sheet']}"
+    source = "DPP 2025" if event['kind'] == 'dpp' else "libro"
+    return f"{event['unidad']} - {event['tipo']} ({source})"
+
+def pending_changes(main_page):
+    seq = st.session_state.setdefault('_watch_seq', change_seq())
+    latest, events = changes_since(seq)
+    return latest, [event for event in events if change_affects(event, main_page)]
+
+def announce_changes(main_page):
+    latest, events = pending_changes(main_page)
+    st.session_state['_watch_seq'] = latest
+    for label in dict.fromkeys(map(change_label, events)):
+        st.toast(f"Datos actualizados: {label}")
+
+@st.fragment(run_every=WATCH_REFRESH_SECONDS)
+def change_listener(main_page):
+    latest, events = pending_changes(main_page)
+    if events:
+        st.rerun(scope="app")
+    st.session_state['_watch_seq'] = latest
 
-    if page == "DPP 2025":
-        if os.path.exists(cache_file):
-            df = pd.read_csv(cache_file)
-        else:
-            try:
-                df = pd.read_excel(file_path, sheet_name=sheet_name)
-            except Exception as e:
-                st.error(f"Error al leer el archivo Excel: {e}")
-                st.stop()
-            df = process_misiones_df(df, sheet_name, unit)
-    else:
+def main():
+    with measured_rerun():
+        # No hay un punto de arranque del servidor antes de la primera sesión:
+        # esa sesión dispara la precarga y espera el libro (ver start_preload)
+        start_preload()
+        start_watcher()
+
+        st.sidebar.title("Navegación")
+        main_page = st.sidebar.selectbox(
+            "Selecciona una página principal:",
+            (*UNIT_REGISTRY, "Coordinación", "Análisis", "Consolidado")
+        )
+        st.title(main_page)
+        announce_changes(main_page)
+
+        with metrics.stage(f"page_{main_page}"):
+            if main_page in UNIT_REGISTRY:
+                handle_unit_page(main_page)
+            elif main_page == "Coordinación":
+                create_consolidado(build_deseados())
+            elif main_page == "Análisis":
+                handle_analysis_page()
+            elif main_page == "Consolidado":
+                handle_consolidado_page()
+
+        change_listener(main_page)
+        if metrics.enabled():
+            metrics_panel()
+
+def handle_unit_page(unit):
+    view = st.sidebar.selectbox("Selecciona una vista:", tuple(TIPOS), key=f"{unit}_view")
+    schema = get_schemas()[(unit, view)]
+    page = st.sidebar.selectbox("Selecciona una subpágina:", ("Requerimiento del área", "DPP 2025"), key=schema.page_key)
+    process_sheet_page(schema, page)
+
+def load_sheet_df(schema, use_cache):
+    df = load_from_cache(schema.unit, schema.tipo) if use_cache else None
+    if df is None:
         try:
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
+            df, failures = load_normalized_sheet(schema.sheet)
+        except SchemaError as e:
+            st.error(str(e))
+            st.stop()
         except Exception as e:
             st.error(f"Error al leer el archivo Excel: {e}")
             st.stop()
-        df = process_misiones_df(df, sheet_name, unit)
+        report_coercion_failures(failures, schema.sheet)
+    return df
 
+def process_sheet_page(schema, page):
     if page == "Requerimiento del área":
-        display_misiones_requerimiento(df, unit)
+        display_requerimiento(load_sheet_df(schema, use_cache=False), schema)
     elif page == "DPP 2025":
-        desired_total = deseados[unit][tipo]
-        edit_misiones_dpp(df, unit, desired_total, tipo, use_objetivo)
-
-def process_consultorias_page(unit, tipo, page, deseados):
-    file_path = 'BDD_Ajuste.xlsx'
-    sheet_name = f"Consultores_{unit}"
-    cache_file = f'cache/{unit}_{tipo}_DPP2025.csv'
-
-    def process_consultorias_df(df, sheet_name, unit):
-        if unit == "VPE":
-            required_columns = ['ÍTEM PRESUPUESTO', 'OFICINA', 'UNID. ORG.', 'ACCIONES', 'CATEGORÍA', 'SUBCATEGORÍA', 'Suma de MONTO']
-        elif unit == "PRE":
-            required_columns = ['Cargo', 'PRE/AREA', 'Nº', 'Monto mensual', 'cantidad meses', 'Total', 'Area imputacion']
-        elif unit == "VPO":
-            required_columns = ['Cargo', 'Nº', 'Monto mensual', 'cantidad meses', 'Total', 'Observaciones', 'Objetivo', 'tipo']
-        else:
-            required_columns = ['Cargo', f"{unit}/AREA", 'Nº', 'Monto mensual', 'cantidad meses', 'Total']
-
-        for col in required_columns:
-            if col not in df.columns:
-                st.error(f"La columna '{col}' no existe en la hoja '{sheet_name}'.")
-                st.stop()
-
-        if unit == "VPE":
-            df['Total'] = pd.to_numeric(df['Suma de MONTO'].astype(str).str.replace(',', '').str.strip(), errors='coerce').fillna(0)
-        elif unit == "PRE":
-            df['Total'] = pd.to_numeric(df['Total'].astype(str).str.replace(',', '').str.strip(), errors='coerce').fillna(0)
-        elif unit == "VPO":
-            if 'Total' not in df.columns or df['Total'].sum() == 0:
-                df['Total'] = df.apply(calculate_total_consultorias, axis=1)
+        edit_dpp(schema, monto_dpp(schema.unit, schema.tipo))
+
+def display_requerimiento(df, schema):
+    st.header(f"{schema.unit} - {schema.tipo}: Requerimiento del área")
+    st.subheader(f"Tabla Completa - {schema.tipo}")
+    formatted_table(df, schema.formats, height=400)
+    requerimiento_totals(schema)
+
+# Totales del requerimiento por dimensión, agregados en SQL sobre el almacén
+DIMENSION_LABELS = {
+    'unidad': 'Unidad Organizacional', 'pais': 'País', 'objetivo': 'Objetivo', 'area': 'Área',
+    'categoria': 'Categoría', 'subcategoria': 'Subcategoría',
+}
+
+def requerimiento_totals(schema):
+    dimensions = [dim for dim, columns in STORE_DIMENSIONS.items() if any(col in schema.required for col in columns)]
+    if not dimensions:
+        return
+    sync_store_workbook()
+    st.subheader(f"Totales - {schema.tipo}")
+    by = st.selectbox("Agrupar por", dimensions, format_func=DIMENSION_LABELS.get, key=f"{schema.unit}_{schema.tipo}_totales_por")
+    totals = store_totals(REQUERIMIENTO, schema.tipo, by, schema.unit)
+    totals = totals.rename(columns={by: DIMENSION_LABELS[by], 'total': 'Total', 'filas': 'Filas'})
+    formatted_table(totals, {'Total': "{:,.2f}"}, hide_index=True)
+
+# Edición por deltas: la grilla devuelve solo las celdas modificadas (fila,
+# columna, valor) en lugar de la tabla completa. Las últimas ediciones viajan
+# con un número de secuencia para no perder cambios hechos entre dos reruns; el
+# servidor aplica solo las que aún no vio sobre la tabla guardada en la sesión y
+# ajusta el total acumulado fila por fila. Si entre dos reruns hubo más de
+# GRID_EDIT_JOURNAL_SIZE ediciones (p. ej. al pegar un bloque), el diario ya
+# perdió las más viejas: desde entonces la grilla envía también todas sus filas
+# y el servidor, al ver el salto en la secuencia, rehace la tabla con ellas y
+# monta la grilla de nuevo (otra clave), lo que reinicia el diario y vuelve a
+# enviar solo las ediciones.
+GRID_EDIT_JOURNAL_SIZE = 50
+GRID_ROW_ID = '::auto_unique_id::'
+
+GRID_EDIT_COLLECTOR = f"""
+    function({{streamlitRerunEventTriggerName, eventData}}) {{
+        var api = eventData.api;
+        api.__dppJournal = api.__dppJournal || [];
+        api.__dppSeq = api.__dppSeq || 0;
+        if (streamlitRerunEventTriggerName === 'cellValueChanged') {{
+            api.__dppSeq += 1;
+            api.__dppJournal.push({{
+                seq: api.__dppSeq,
+                row: eventData.data['{GRID_ROW_ID}'],
+                column: eventData.colDef.field,
+                value: eventData.newValue
+            }});
+            if (api.__dppJournal.length > {GRID_EDIT_JOURNAL_SIZE}) {{
+                api.__dppJournal = api.__dppJournal.slice(-{GRID_EDIT_JOURNAL_SIZE});
+                api.__dppTruncated = true;
+            }}
+        }}
+        var rows = null;
+        if (api.__dppTruncated) {{
+            rows = [];
+            api.forEachNode(function(node) {{ rows.push(node.data); }});
+        }}
+        return {{edits: api.__dppJournal, rows: rows}};
+    }}
+"""
+
+def new_dpp_state(df, schema, version=0):
+    df = df.reset_index(drop=True)
+    for col in (*schema.required, 'Total'):
+        if col not in df.columns:
+            st.error(f"La columna '{col}' está ausente en los datos editados.")
+            st.stop()
+    df, failures = dpp_frame(df, schema)
+    report_coercion_failures(failures, f"{schema.unit} - {schema.tipo}")
+    return {'df': df, 'total': float(df['Total'].sum()), 'seq': 0, 'grid_data': None, 'grid_mount': 0,
+            'version': version, 'base': df.copy()}
+
+# Guardado con versión: la sesión guarda sobre la versión que editó ('base') y
+# adopta la tabla fusionada si otra sesión guardó antes. Sin cambios propios,
+# solo se actualiza si hay una versión más nueva. Devuelve True si la tabla de
+# la sesión cambió y hay que volver a dibujar la grilla.
+def sync_dpp_state(state, schema, save):
+    if save:
+        result = save_to_cache(state['df'], schema.unit, schema.tipo, state['version'], state['base'])
+        version, df = result['version'], result['df']
+        if result['conflicts'] is None:
+            st.warning("La tabla cambió de estructura en otra sesión; se cargó la versión guardada.")
+        elif result['conflicts']:
+            st.warning(f"{result['conflicts']} celdas también fueron editadas en otra sesión; se mantuvo el valor guardado allí.")
+    else:
+        head = load_versioned(schema.unit, schema.tipo)
+        if head is None or head[0] <= state['version']:
+            return False
+        version, df = head
+        st.info("Se cargaron cambios guardados en otra sesión.")
+
+    state['version'] = version
+    if df is None:
+        state['base'] = state['df'].copy()
+        return False
+    df = df.reset_index(drop=True)
+    state.update(df=df, total=float(df['Total'].sum()), base=df.copy(), grid_data=df.copy())
+    return True
+
+def resync_grid_rows(state, rows, schema):
+    df = pd.DataFrame(rows)
+    df = df.set_index(df[GRID_ROW_ID].astype(int)).sort_index()
+    df, failures = dpp_frame(df.reindex(columns=state['df'].columns), schema)
+    state.update(df=df, total=float(df['Total'].sum()))
+    metrics.count('grid_resyncs')
+    return failures
+
+@metrics.timed('apply_edits')
+def apply_grid_edits(state, edits, schema, rows=None):
+    pending = [edit for edit in edits if edit['seq'] > state['seq']]
+    if pending and min(edit['seq'] for edit in pending) > state['seq'] + 1:
+        # Faltan ediciones que salieron del diario: se toma la grilla completa
+        state['grid_mount'] += 1
+        if rows is None:
+            state['grid_notice'] = "Se perdieron ediciones de la grilla; se volvió a cargar la tabla de la sesión."
+            return 0, {}
+        return len(pending), resync_grid_rows(state, rows, schema)
+
+    df = state['df']
+    failures = {}
+    applied = 0
+    for edit in sorted(edits, key=lambda e: e['seq']):
+        if edit['seq'] <= state['seq']:
+            continue
+        state['seq'] = edit['seq']
+        row, col = int(edit['row']), edit['column']
+        if col not in df.columns or col == 'Total' or not 0 <= row < len(df):
+            continue
+        value = edit['value']
+        if col in schema.numeric:
+            value, ok = parse_number(value)
+            if not ok:
+                failures[col] = failures.get(col, 0) + 1
+        df.at[row, col] = value
+        if col in schema.editable:
+            new_total = float(schema.compute_total(df.iloc[[row]])[0])
+            state['total'] += new_total - df.at[row, 'Total']
+            df.at[row, 'Total'] = new_total
+        applied += 1
+    metrics.count('grid_edits', applied)
+    return applied, failures
+
+# Ajuste automático al Monto DPP 2025 (el solver vive en ppt_core)
+def apply_budget_fit(state, schema, column, target, locked_rows, integer):
+    df = state['df']
+    locked = np.zeros(len(df), dtype=bool)
+    locked[list(locked_rows)] = True
+    base, slope = linear_terms(df, schema, column)
+    df[column] = solve_budget_fit(base, slope, df[column].to_numpy(dtype=float), target, locked, integer)
+    df['Total'] = schema.compute_total(df)
+    state['total'] = float(df['Total'].sum())
+    state['grid_data'] = df.copy()
+    # El aviso se muestra después del rerun que vuelve a dibujar la grilla
+    difference = target - state['total']
+    if difference <= -0.005:
+        state['fit_notice'] = ("Las filas bloqueadas ya superan el Monto DPP 2025: las filas libres quedaron en 0 "
+                               f"y sobran {-difference:,.2f} USD.")
+    elif difference >= 0.005:
+        state['fit_notice'] = f"Con valores enteros quedó una diferencia de {difference:,.2f} USD."
+
+def budget_fit_panel(state, schema, desired_total):
+    df = state['df']
+    with st.expander("Ajuste automático", expanded='fit_notice' in state):
+        if 'fit_notice' in state:
+            st.warning(state.pop('fit_notice'))
+        default = next((col for col in ('Días', 'cantidad meses') if col in schema.editable), schema.editable[0])
+        column = st.selectbox("Columna a ajustar", schema.editable, index=schema.editable.index(default),
+                              key=f"fit_column_{schema.unit}_{schema.tipo}")
+        integer = st.checkbox("Solo valores enteros", value=column in COUNT_COLUMNS,
+                              key=f"fit_integer_{schema.unit}_{schema.tipo}_{column}")
+        label_col = next((col for col in schema.required if col not in schema.numeric), None)
+        locked_rows = st.multiselect(
+            "Filas bloqueadas", range(len(df)),
+            format_func=lambda i: f"{i}: {df.at[i, label_col]}" if label_col else str(i),
+            key=f"fit_locked_{schema.unit}_{schema.tipo}"
+        )
+        if st.button("Aplicar ajuste", key=f"fit_apply_{schema.unit}_{schema.tipo}"):
+            apply_budget_fit(state, schema, column, desired_total, locked_rows, integer)
+            sync_dpp_state(state, schema, save=True)
+            st.rerun()
+
+# Historial de la tabla: volver a una versión anterior la guarda como una
+# versión nueva, así que restaurar también se puede deshacer.
+def history_panel(state, schema):
+    unit, tipo = schema.unit, schema.tipo
+    with st.expander("Historial de cambios"):
+        versions = history_versions(unit, tipo)
+        if versions.empty:
+            st.write("Todavía no hay cambios guardados.")
         else:
-            numeric_columns = ['Nº', 'Monto mensual', 'cantidad meses', 'Total']
-            for col in numeric_columns:
-                if col in df.columns:
-                    df[col] = pd.to_numeric(df[col].astype(str).str.replace(',', '').str.strip(), errors='coerce').fillna(0)
+            labels = {row.version: f"v{row.version} - {row.fecha} ({row.celdas} celdas)" for row in versions.itertuples()}
+            version = st.selectbox("Versión", list(labels), format_func=labels.get, key=f"history_version_{unit}_{tipo}")
+            if st.button("Restaurar esta versión", key=f"history_restore_{unit}_{tipo}"):
+                df = table_at_version(unit, tipo, version)
+                if df is None:
+                    st.warning("No se encontró la foto de esa versión.")
                 else:
-                    st.error(f"La columna '{col}' no existe en la hoja '{sheet_name}'.")
-                    st.stop()
+                    state.update(df=df, total=float(df['Total'].sum()), grid_data=df.copy())
+                    sync_dpp_state(state, schema, save=True)
+                    st.rerun()
 
-            if 'Total' not in df.columns or df['Total'].sum() == 0:
-                df['Total'] = df.apply(calculate_total_consultorias, axis=1)
-
-        return df
-
-    if page == "DPP 2025":
-        if os.path.exists(cache_file):
-            df = pd.read_csv(cache_file)
-        else:
-            try:
-                df = pd.read_excel(file_path, sheet_name=sheet_name)
-            except Exception as e:
-                st.error(f"Error al leer el archivo Excel: {e}")
-                st.stop()
-            df = process_consultorias_df(df, sheet_name, unit)
-    else:
+        st.subheader("Diferencias con el Requerimiento del área")
         try:
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
+            original = excel_dpp_frame(schema)
         except Exception as e:
-            st.error(f"Error al leer el archivo Excel: {e}")
-            st.stop()
-        df = process_consultorias_df(df, sheet_name, unit)
-
-    if page == "Requerimiento del área":
-        display_consultorias_requerimiento(df, unit)
-    elif page == "DPP 2025":
-        desired_total = deseados[unit][tipo]
-        edit_consultorias_dpp(df, unit, desired_total, tipo)
-
-def display_misiones_requerimiento(df, unit):
-    st.header(f"{unit} - Misiones: Requerimiento del área")
-    st.subheader("Tabla Completa - Misiones")
-    if unit == "VPE":
-        st.dataframe(
-            df.style.format({
-                "ÍTEM PRESUPUESTO": "{}",
-                "OFICINA": "{}",
-                "UNID. ORG.": "{}",
-                "ACCIONES": "{}",
-                "CATEGORÍA": "{}",
-                "SUBCATEGORÍA": "{}",
-                "Suma de MONTO": "{:,.2f}",
-                "Total": "{:,.2f}"
-            }),
-            height=400
-        )
-    elif unit == "PRE":
-        st.dataframe(
-            df.style.format({
-                "País": "{}",
-                "Operación": "{}",
-                "PRE o VP": "{}",
-                "Cantidad de Funcionarios": "{:.0f}",
-                "Días": "{:.0f}",
-                "Costo de Pasaje": "{:,.2f}",
-                "Alojamiento": "{:,.2f}",
-                "Per-diem y Otros": "{:,.2f}",
-                "Movilidad": "{:,.2f}",
-                "Total": "{:,.2f}",
-                "Area imputacion": "{}"
-            }),
-            height=400
-        )
-    else:
-        st.dataframe(
-            df.style.format({
-                "País": "{}",
-                "Cantidad de Funcionarios": "{:.0f}",
-                "Días": "{:.0f}",
-                "Costo de Pasaje": "{:,.2f}",
-                "Alojamiento": "{:,.2f}",
-                "Per-diem y Otros": "{:,.2f}",
-                "Movilidad": "{:,.2f}",
-                "Total": "{:,.2f}"
-            }),
-            height=400
-        )
-
-def display_consultorias_requerimiento(df, unit):
-    st.header(f"{unit} - Consultorías: Requerimiento del área")
-    st.subheader("Tabla Completa - Consultorías")
-    if unit == "VPE":
-        st.dataframe(
-            df.style.format({
-                "ÍTEM PRESUPUESTO": "{}",
-                "OFICINA": "{}",
-                "UNID. ORG.": "{}",
-                "ACCIONES": "{}",
-                "CATEGORÍA": "{}",
-                "SUBCATEGORÍA": "{}",
-                "Suma de MONTO": "{:,.2f}",
-                "Total": "{:,.2f}"
-            }),
-            height=400
-        )
-    elif unit == "PRE":
-        st.dataframe(
-            df.style.format({
-                "Cargo": "{}",
-                "PRE/AREA": "{}",
-                "Nº": "{:.0f}",
-                "Monto mensual": "{:,.2f}",
-                "cantidad meses": "{:.0f}",
-                "Total": "{:,.2f}",
-                "Area imputacion": "{}"
-            }),
-            height=400
-        )
-    elif unit == "VPO":
-        st.dataframe(
-            df.style.format({
-                "Cargo": "{}",
-                "Nº": "{:.0f}",
-                "Monto mensual": "{:,.2f}",
-                "cantidad meses": "{:.0f}",
-                "Total": "{:,.2f}",
-                "Observaciones": "{}",
-                "Objetivo": "{}",
-                "tipo": "{}"
-            }),
-            height=400
-        )
-    else:
-        st.dataframe(
-            df.style.format({
-                "Cargo": "{}",
-                f"{unit}/AREA": "{}",
-                "Nº": "{:.0f}",
-                "Monto mensual": "{:,.2f}",
-                "cantidad meses": "{:.0f}",
-                "Total": "{:,.2f}"
-            }),
-            height=400
-        )
-
-def edit_misiones_dpp(df, unit, desired_total, tipo, use_objetivo):
-    st.header(f"{unit} - Misiones: DPP 2025")
+            st.warning(f"No se pudo leer la hoja '{schema.sheet}': {e}")
+            return
+        diff = diff_frames(original, state['df'])
+        st.write(f"{len(diff)} celdas distintas.")
+        if not diff.empty:
+            st.dataframe(diff.astype({'original': str, 'actual': str}), height=300)
+
+# Descargas generadas al hacer clic (el botón recibe una función), no en cada rerun
+@metrics.timed('download_csv')
+def table_csv(df):
+    return df.assign(Total=df['Total'].round(2)).to_csv(index=False).encode('utf-8')
+
+def package_xlsx():
+    with open(dpp_package_xlsx(), 'rb') as f:
+        return f.read()
+
+def package_download(container=st):
+    container.download_button(label="Descargar todo (XLSX)", data=package_xlsx, file_name="presupuesto_DPP2025.xlsx",
+                              mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", on_click="ignore",
+                              key="package_xlsx")
+
+def edit_dpp(schema, desired_total):
+    unit, tipo = schema.unit, schema.tipo
+    st.header(f"{unit} - {tipo}: DPP 2025")
     st.subheader(f"Monto DPP 2025: {desired_total:,.2f} USD")
     st.write("Edita los valores en la tabla para ajustar el presupuesto.")
 
-    gb = GridOptionsBuilder.from_dataframe(df)
-    gb.configure_default_column(editable=True, groupable=True)
-
-    if unit == "VPE":
-        editable_columns = ['Suma de MONTO']
-        gb.configure_columns(editable_columns, editable=True, type=['numericColumn'],
-                             valueFormatter="Math.round(x).toLocaleString(undefined, {minimumFractionDigits: 2, maximumFractionDigits: 2})")
-    elif unit == "PRE":
-        editable_columns = ['Cantidad de Funcionarios', 'Días', 'Costo de Pasaje', 'Alojamiento', 'Per-diem y Otros', 'Movilidad']
-        for col in editable_columns:
-            gb.configure_column(
-                col,
-                editable=True,
-                type=['numericColumn'],
-                valueFormatter="Math.round(x).toLocaleString(undefined, {minimumFractionDigits: 2, maximumFractionDigits: 2})"
-            )
-        gb.configure_column('Total', editable=False, valueGetter=JsCode("""
-            function(params) {
-                return Math.round(
-                    (Number(params.data['Costo de Pasaje']) + 
-                    (Number(params.data['Alojamiento']) + Number(params.data['Per-diem y Otros']) + Number(params.data['Movilidad'])) * 
-                    Number(params.data['Días'])) * 
-                    Number(params.data['Cantidad de Funcionarios'])
-                * 100) / 100;
-            }
-        """))
-    else:
-        numeric_columns_aggrid = ['Cantidad de Funcionarios', 'Días', 'Costo de Pasaje',
-                                  'Alojamiento', 'Per-diem y Otros', 'Movilidad', 'Total']
-        for col in numeric_columns_aggrid:
-            gb.configure_column(
-                col,
-                type=['numericColumn'],
-                valueFormatter="Math.round(x).toLocaleString(undefined, {minimumFractionDigits: 2, maximumFractionDigits: 2})"
-            )
-
-        gb.configure_column('Total', editable=False, valueGetter=JsCode("""
-            function(params) {
-                return Math.round(
-                    (Number(params.data['Costo de Pasaje']) + 
-                    (Number(params.data['Alojamiento']) + Number(params.data['Per-diem y Otros']) + Number(params.data['Movilidad'])) * 
-                    Number(params.data['Días'])) * 
-                    Number(params.data['Cantidad de Funcionarios'])
-                * 100) / 100;
-            }
-        """))
-
-    gb.configure_grid_options(domLayout='normal')
-    grid_options = gb.build()
-
-    grid_response = AgGrid(
-        df,
-        gridOptions=grid_options,
-        data_return_mode=DataReturnMode.FILTERED,
-        update_mode='MODEL_CHANGED',
-        fit_columns_on_grid_load=False,
-        height=400,
-        width='100%',
-        enable_enterprise_modules=False,
-        allow_unsafe_jscode=True,
-        theme='alpine'
-    )
-
-    edited_df = pd.DataFrame(grid_response['data'])
-
-    if unit == "VPE":
-        essential_cols = ['ÍTEM PRESUPUESTO', 'OFICINA', 'UNID. ORG.', 'ACCIONES', 'CATEGORÍA', 'SUBCATEGORÍA', 'Suma de MONTO', 'Total']
-    elif unit == "PRE":
-        essential_cols = ['País', 'Operación', 'PRE o VP', 'Cantidad de Funcionarios', 'Días',
-                          'Costo de Pasaje', 'Alojamiento', 'Per-diem y Otros', 'Movilidad', 'Total', 'Area imputacion']
-    else:
-        essential_cols = ['Cantidad de Funcionarios', 'Días', 'Costo de Pasaje',
-                          'Alojamiento', 'Per-diem y Otros', 'Movilidad', 'Total']
-        if use_objetivo:
-            essential_cols.append('Objetivo')
+    state_key = f"DPP_{unit}_{tipo}"
+    created = state_key not in st.session_state
+    if created:
+        head = load_versioned(unit, tipo)
+        if head is None:
+            st.session_state[state_key] = new_dpp_state(load_sheet_df(schema, use_cache=False), schema)
+        else:
+            st.session_state[state_key] = new_dpp_state(head[1], schema, head[0])
+    state = st.session_state[state_key]
+    mount = state['grid_mount']
+    grid_key = f"grid_{unit}_{tipo}_{mount}"
+    if grid_key not in st.session_state:
+        # La grilla se monta de nuevo: parte del estado actual y reinicia la secuencia
+        state['grid_data'] = state['df'].copy()
+        state['seq'] = 0
+
+    from st_aggrid import AgGrid, DataReturnMode, JsCode
+    grid_options = grid_options_for(('DPP', unit, tipo), state['df'], configure_dpp_grid(schema))
+
+    with metrics.stage('aggrid'):
+        grid_response = AgGrid(
+            state['grid_data'],
+            gridOptions=grid_options,
+            data_return_mode=DataReturnMode.CUSTOM,
+            custom_jscode_for_grid_return=JsCode(GRID_EDIT_COLLECTOR),
+            update_on=['cellValueChanged'],
+            fit_columns_on_grid_load=False,
+            height=400,
+            width='100%',
+            enable_enterprise_modules=False,
+            allow_unsafe_jscode=True,
+            theme='alpine',
+            key=grid_key
+        )
 
-    for col in essential_cols:
-        if col not in edited_df.columns:
-            st.error(f"La columna '{col}' está ausente en los datos editados.")
-            st.stop()
+    grid_return = grid_response if grid_response is not None else {}
+    applied, failures = apply_grid_edits(state, grid_return.get('edits') or [], schema, grid_return.get('rows'))
+    report_coercion_failures(failures, f"{unit} - {tipo}")
+    if sync_dpp_state(state, schema, save=bool(applied) or created) or state['grid_mount'] != mount:
+        st.rerun()
+    if 'grid_notice' in state:
+        st.warning(state.pop('grid_notice'))
 
-    if unit == "VPE":
-        numeric_columns = ['Suma de MONTO']
-        for col in numeric_columns:
-            edited_df[col] = pd.to_numeric(edited_df[col].astype(str).str.replace(',', '').str.strip(), errors='coerce').fillna(0)
-        edited_df['Total'] = edited_df['Suma de MONTO']
-    elif unit == "PRE":
-        numeric_columns = ['Cantidad de Funcionarios', 'Días', 'Costo de Pasaje', 'Alojamiento', 'Per-diem y Otros', 'Movilidad']
-        for col in numeric_columns:
-            edited_df[col] = pd.to_numeric(edited_df[col].astype(str).str.replace(',', '').str.strip(), errors='coerce').fillna(0)
-        edited_df['Total'] = edited_df.apply(calculate_total_misiones, axis=1)
-    else:
-        numeric_columns = ['Cantidad de Funcionarios', 'Días', 'Costo de Pasaje',
-                           'Alojamiento', 'Per-diem y Otros', 'Movilidad', 'Total']
-        for col in numeric_columns:
-            edited_df[col] = pd.to_numeric(edited_df[col].astype(str).str.replace(',', '').str.strip(), errors='coerce').fillna(0)
-        edited_df['Total'] = edited_df.apply(calculate_total_misiones, axis=1)
+    budget_fit_panel(state, schema, desired_total)
+    history_panel(state, schema)
 
-    total_sum = edited_df['Total'].sum()
+    edited_df = state['df']
+    total_sum = state['total']
     difference = desired_total - total_sum
 
     col1, col2 = st.columns(2)
     col1.metric("Monto Actual (USD)", f"{total_sum:,.2f}")
     col2.metric("Diferencia con el Monto DPP 2025 (USD)", f"{difference:,.2f}")
 
-    save_to_cache(edited_df, unit, tipo)
-
     st.subheader("Descargar Tabla Modificada")
-    edited_df['Total'] = edited_df['Total'].round(2)
-    csv = edited_df.to_csv(index=False).encode('utf-8')
-    st.download_button(label="Descargar CSV", data=csv, file_name=f"tabla_modificada_{tipo.lower()}_{unit.lower()}.csv", mime="text/csv")
-
-def edit_consultorias_dpp(df, unit, desired_total, tipo):
-    st.header(f"{unit} - Consultorías: DPP 2025")
-    st.subheader(f"Monto DPP 2025: {desired_total:,.2f} USD")
-    st.write("Edita los valores en la tabla para ajustar el presupuesto.")
-
-    gb = GridOptionsBuilder.from_dataframe(df)
-    gb.configure_default_column(editable=True, groupable=True)
-
-    if unit == "VPE":
-        editable_columns = ['Suma de MONTO']
-        gb.configure_columns(editable_columns, editable=True, type=['numericColumn'],
-                             valueFormatter="Math.round(x).toLocaleString(undefined, {minimumFractionDigits: 2, maximumFractionDigits: 2})")
-    elif unit == "PRE":
-        editable_columns = ['Nº', 'Monto mensual', 'cantidad meses']
-        for col in editable_columns:
-            gb.configure_column(
-                col,
-                editable=True,
-                type=['numericColumn'],
-                valueFormatter="Math.round(x).toLocaleString(undefined, {minimumFractionDigits: 2, maximumFractionDigits: 2})"
-            )
-        gb.configure_column('Total', editable=False, valueGetter=JsCode("""
-            function(params) {
-                return Math.round(
-                    Number(params.data['Nº']) * Number(params.data['Monto mensual']) * Number(params.data['cantidad meses'])
-                * 100) / 100;
-            }
-        """))
-    elif unit == "VPO":
-        editable_columns = ['Nº', 'Monto mensual', 'cantidad meses']
-        for col in editable_columns:
-            gb.configure_column(
-                col,
-                editable=True,
-                type=['numericColumn'],
-                valueFormatter="Math.round(x).toLocaleString(undefined, {minimumFractionDigits: 2, maximumFractionDigits: 2})"
-            )
-        gb.configure_column('Total', editable=False, valueGetter=JsCode("""
-            function(params) {
-                return Math.round(
-                    Number(params.data['Nº']) * Number(params.data['Monto mensual']) * Number(params.data['cantidad meses'])
-                * 100) / 100;
-            }
-        """))
-    else:
-        numeric_columns_aggrid = ['Nº', 'Monto mensual', 'cantidad meses', 'Total']
-        for col in numeric_columns_aggrid:
-            gb.configure_column(
-                col,
-                type=['numericColumn'],
-                valueFormatter="Math.round(x).toLocaleString(undefined, {minimumFractionDigits: 2, maximumFractionDigits: 2})"
-            )
-
-        gb.configure_column('Total', editable=False, valueGetter=JsCode("""
-            function(params) {
-                return Math.round(
-                    Number(params.data['Nº']) * Number(params.data['Monto mensual']) * Number(params.data['cantidad meses'])
-                * 100) / 100;
-            }
-        """))
-
-    gb.configure_grid_options(domLayout='normal')
-    grid_options = gb.build()
-
-    grid_response = AgGrid(
-        df,
-        gridOptions=grid_options,
-        data_return_mode=DataReturnMode.FILTERED,
-        update_mode='MODEL_CHANGED',
-        fit_columns_on_grid_load=False,
-        height=400,
-        width='100%',
-        enable_enterprise_modules=False,
-        allow_unsafe_jscode=True,
-        theme='alpine'
-    )
-
-    edited_df = pd.DataFrame(grid_response['data'])
-
-    if unit == "VPE":
-        essential_cols = ['ÍTEM PRESUPUESTO', 'OFICINA', 'UNID. ORG.', 'ACCIONES', 'CATEGORÍA', 'SUBCATEGORÍA', 'Suma de MONTO', 'Total']
-    elif unit == "PRE":
-        essential_cols = ['Cargo', 'PRE/AREA', 'Nº', 'Monto mensual', 'cantidad meses', 'Total', 'Area imputacion']
-    elif unit == "VPO":
-        essential_cols = ['Cargo', 'Nº', 'Monto mensual', 'cantidad meses', 'Total', 'Observaciones', 'Objetivo', 'tipo']
-    else:
-        essential_cols = ['Cargo', f"{unit}/AREA", 'Nº', 'Monto mensual', 'cantidad meses', 'Total']
-
-    for col in essential_cols:
-        if col not in edited_df.columns:
-            st.error(f"La columna '{col}' está ausente en los datos editados.")
-            st.stop()
-
-    if unit == "VPE":
-        numeric_columns = ['Suma de MONTO']
-        for col in numeric_columns:
-            edited_df[col] = pd.to_numeric(edited_df[col].astype(str).str.replace(',', '').str.strip(), errors='coerce').fillna(0)
-        edited_df['Total'] = edited_df['Suma de MONTO']
-    elif unit == "PRE":
-        numeric_columns = ['Nº', 'Monto mensual', 'cantidad meses']
-        for col in numeric_columns:
-            edited_df[col] = pd.to_numeric(edited_df[col].astype(str).str.replace(',', '').str.strip(), errors='coerce').fillna(0)
-        edited_df['Total'] = edited_df.apply(calculate_total_consultorias, axis=1)
-    else:
-        numeric_columns = ['Nº', 'Monto mensual', 'cantidad meses', 'Total']
-        for col in numeric_columns:
-            edited_df[col] = pd.to_numeric(edited_df[col].astype(str).str.replace(',', '').str.strip(), errors='coerce').fillna(0)
-        edited_df['Total'] = edited_df.apply(calculate_total_consultorias, axis=1)
-
-    total_sum = edited_df['Total'].sum()
-    difference = desired_total - total_sum
-
     col1, col2 = st.columns(2)
-    col1.metric("Monto Actual (USD)", f"{total_sum:,.2f}")
-    col2.metric("Diferencia con el Monto DPP 2025 (USD)", f"{difference:,.2f}")
-
-    save_to_cache(edited_df, unit, tipo)
-
-    st.subheader("Descargar Tabla Modificada")
-    edited_df['Total'] = edited_df['Total'].round(2)
-    csv = edited_df.to_csv(index=False).encode('utf-8')
-    st.download_button(label="Descargar CSV", data=csv, file_name=f"tabla_modificada_{tipo.lower()}_{unit.lower()}.csv", mime="text/csv")
+    col1.download_button(label="Descargar CSV", data=lambda: table_csv(edited_df), file_name=f"tabla_modificada_{tipo.lower()}_{unit.lower()}.csv",
+                         mime="text/csv", on_click="ignore", key=f"csv_{unit}_{tipo}")
+    package_download(col2)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,171 @@
+import argparse
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from ppt_core import (
+    EXCEL_FILE, TIPOS, UNIT_REGISTRY, SchemaError,
+    INGEST_CHUNK_ROWS, get_schemas, load_from_cache, dpp_frame,
+    stream_sheet, monto_dpp, consolidado_tables, to_arrow, sheet_name, write_xlsx,
+)
+
+# Modo por lotes sin interfaz: cada hoja de unidad se lee y normaliza en su
+# propio proceso (lectura, validación, limpieza numérica y Total), escribe
+# las tablas y el resumen de Coordinación en CSV, Parquet y/o XLSX y termina con
+# código distinto de cero si alguna hoja no cumple su esquema.
+#
+#   python ppt_batch.py --out salida --format csv --format xlsx
+#
+# Con --stream cada proceso lee su hoja por bloques (openpyxl en modo solo
+# lectura) y va agregando cada bloque al CSV/Parquet de salida, así que la
+# memoria queda acotada al tamaño del bloque; el resumen usa los totales
+# acumulados.
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_SCHEMA = 2
+
+FORMATS = ('csv', 'parquet', 'xlsx')
+
+# La lectura de la hoja es lo lento, así que se hace en el proceso hijo (pandas
+# abre el libro en modo solo lectura y parsea solo esa hoja). Las tablas
+# guardadas de --use-cache se leen en el proceso principal, que es barato.
+def read_sheet(schema, excel):
+    with pd.ExcelFile(excel) as book:
+        if schema.sheet not in book.sheet_names:
+            raise SchemaError(f"La hoja '{schema.sheet}' no existe en el libro.")
+        return book.parse(schema.sheet)
+
+def process_sheet(schema, excel, df=None):
+    if df is None:
+        df = read_sheet(schema, excel)
+    return dpp_frame(df, schema)
+
+def collect_jobs(schemas, excel, use_cache):
+    jobs = []
+    for schema in schemas:
+        df = load_from_cache(schema.unit, schema.tipo) if use_cache else None
+        jobs.append((schema, process_sheet, (schema, excel, df)))
+    return jobs
+
+# Los bloques se escriben con tipos estables (números como float, el resto como
+# texto) para que todos compartan el esquema del primer bloque en Parquet.
+def _stream_arrow(df):
+    numeric = df.select_dtypes(include='number').columns
+    df = df.astype({col: float if col in numeric else 'str' for col in df.columns})
+    return to_arrow(df)
+
+def stream_sheet_job(schema, excel, out_dir, formats, chunk_rows):
+    name = output_name(schema)
+    csv_path = os.path.join(out_dir, f"{name}.csv")
+    parquet = {}
+
+    def sink(chunk):
+        if 'csv' in formats:
+            chunk.to_csv(csv_path, mode='a' if os.path.exists(csv_path) else 'w', header=not os.path.exists(csv_path), index=False)
+        if 'parquet' in formats:
+            table = _stream_arrow(chunk)
+            if 'writer' not in parquet:
+                parquet['writer'] = pq.ParquetWriter(os.path.join(out_dir, f"{name}.parquet"), table.schema)
+            parquet['writer'].write_table(table.cast(parquet['writer'].schema))
+
+    for ext in ('csv', 'parquet'):
+        if os.path.exists(os.path.join(out_dir, f"{name}.{ext}")):
+            os.remove(os.path.join(out_dir, f"{name}.{ext}"))
+    try:
+        return stream_sheet(schema, excel, chunk_rows, sink)
+    finally:
+        if 'writer' in parquet:
+            parquet['writer'].close()
+
+def output_name(schema):
+    return sheet_name(schema.unit, schema.tipo)
+
+def write_tables(tables, out_dir, formats):
+    os.makedirs(out_dir, exist_ok=True)
+    for name, df in tables.items():
+        if 'csv' in formats:
+            df.to_csv(os.path.join(out_dir, f"{name}.csv"), index=False)
+        if 'parquet' in formats:
+            pq.write_table(to_arrow(df), os.path.join(out_dir, f"{name}.parquet"))
+    if 'xlsx' in formats:
+        write_xlsx(tables, os.path.join(out_dir, 'presupuesto.xlsx'))
+
+def run(excel, out_dir, formats, workers=None, units=None, use_cache=False, stream=False, chunk_rows=INGEST_CHUNK_ROWS):
+    schemas = [schema for schema in get_schemas().values() if not units or schema.unit in units]
+    if stream:
+        os.makedirs(out_dir, exist_ok=True)
+        jobs = [(schema, stream_sheet_job, (schema, excel, out_dir, formats, chunk_rows)) for schema in schemas]
+    else:
+        jobs = collect_jobs(schemas, excel, use_cache)
+
+    tables = {}
+    aggregates = {}
+    status = EXIT_OK
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [(schema, executor.submit(fn, *args)) for schema, fn, args in jobs]
+        for schema, future in futures:
+            try:
+                result = future.result()
+            except SchemaError as e:
+                logging.error("%s", e)
+                status = EXIT_SCHEMA
+                continue
+            except Exception as e:
+                logging.error("No se pudo procesar la hoja '%s': %s", schema.sheet, e)
+                status = max(status, EXIT_FAILED)
+                continue
+            if stream:
+                aggregate = result
+                failures = aggregate.pop('failures')
+            else:
+                df, failures = result
+                tables[output_name(schema)] = df
+                aggregate = {'total': float(df['Total'].sum()), 'rows': len(df)}
+            for col, n in failures.items():
+                logging.warning("Hoja '%s': %d celdas no numéricas en '%s' se tomaron como 0.", schema.sheet, n, col)
+            aggregates[(schema.unit, schema.tipo)] = aggregate
+            logging.info("%s - %s: %d filas, total %s", schema.unit, schema.tipo, aggregate['rows'], f"{aggregate['total']:,.2f}")
+
+    # El resumen solo es válido si se procesaron todas las unidades
+    if status == EXIT_OK and not units:
+        try:
+            deseados = {unit: {tipo: monto_dpp(unit, tipo, excel) for tipo in TIPOS} for unit in UNIT_REGISTRY}
+        except Exception as e:
+            logging.error("No se pudo calcular el Monto DPP 2025: %s", e)
+            status = EXIT_FAILED
+        else:
+            for tipo, table in consolidado_tables(deseados, aggregates).items():
+                tables[f"Coordinacion_{TIPOS[tipo]['key']}"] = table
+
+    write_tables(tables, out_dir, formats)
+    return status
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Procesa el libro de presupuesto sin la interfaz de Streamlit.")
+    parser.add_argument('--excel', default=EXCEL_FILE, help="libro de entrada (por defecto %(default)s)")
+    parser.add_argument('--out', default='salida', help="carpeta de salida (por defecto %(default)s)")
+    parser.add_argument('--format', dest='formats', action='append', choices=FORMATS,
+                        help="formato de salida; se puede repetir (por defecto csv)")
+    parser.add_argument('--workers', type=int, default=None, help="procesos en paralelo (por defecto, uno por CPU)")
+    parser.add_argument('--unit', dest='units', action='append', choices=list(UNIT_REGISTRY),
+                        help="procesar solo esta unidad; se puede repetir")
+    parser.add_argument('--use-cache', action='store_true',
+                        help="usar las tablas DPP 2025 editadas en la app cuando existan")
+    parser.add_argument('--stream', action='store_true',
+                        help="leer las hojas por bloques con memoria acotada (solo csv y parquet)")
+    parser.add_argument('--chunk-rows', type=int, default=INGEST_CHUNK_ROWS,
+                        help="filas por bloque con --stream (por defecto %(default)s)")
+    args = parser.parse_args(argv)
+    formats = args.formats or ['csv']
+    if args.stream and ('xlsx' in formats or args.use_cache):
+        parser.error("--stream no admite --format xlsx ni --use-cache")
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    return run(args.excel, args.out, formats, args.workers, args.units, args.use_cache, args.stream, args.chunk_rows)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,271 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from ppt_core import (
+    EXCEL_FILE, TIPOS, UNIT_REGISTRY, COUNT_COLUMNS, CacheWriter,
+    get_schemas, coerce_numeric_columns, normalize_sheet_df, dpp_frame, read_cache_table,
+    cache_aggregates, monto_dpp, consolidado_tables, reset_process_state,
+)
+
+# Banco de pruebas de rendimiento sin navegador. Genera libros sintéticos con
+# las mismas hojas que BDD_Ajuste.xlsx (Misiones_*, Consultores_*, consolidadoV2 y
+# Consolidado) y N filas por hoja, tomando filas reales al azar y variando los
+# montos; un 1% de las celdas numéricas va como texto ("1,234.50") para que la
+# limpieza numérica tenga trabajo. Mide cada etapa por separado y agrega los
+# resultados a bench/results.jsonl junto con el commit, para comparar:
+#
+#   python ppt_bench.py --rows 1000 --rows 10000 --rows 100000
+#   python ppt_bench.py --rows 10000 --compare HEAD~1
+#   python ppt_bench.py --imports
+#
+# Cada tamaño corre en bench/work_<filas>, donde el libro sintético se llama
+# BDD_Ajuste.xlsx y el cache queda en cache/, como en la app.
+BENCH_DIR = 'bench'
+RESULTS_FILE = f"{BENCH_DIR}/results.jsonl"
+DEFAULT_ROWS = (1000, 10000, 100000)
+TEXT_NUMBER_RATE = 0.01
+
+def synthetic_sheet(df, rows, rng, coerced=()):
+    if df.empty:
+        return df
+    out = df.iloc[rng.integers(0, len(df), rows)].reset_index(drop=True)
+    for col in out.select_dtypes(include='number').columns:
+        values = out[col].to_numpy(dtype=float)
+        if col not in COUNT_COLUMNS:
+            values = np.round(values * rng.uniform(0.5, 1.5, rows), 2)
+        out[col] = values
+        if col in coerced:
+            as_text = rng.random(rows) < TEXT_NUMBER_RATE
+            column = pd.Series(values, dtype=object)
+            column[as_text] = [f"{v:,.2f}" for v in values[as_text]]
+            out[col] = column
+    return out
+
+def write_workbook(path, rows, seed, source=EXCEL_FILE):
+    rng = np.random.default_rng(seed)
+    sheets = pd.read_excel(source, sheet_name=None)
+    coerced = {schema.sheet: schema.numeric for schema in get_schemas().values()}
+    engine = 'xlsxwriter' if _has_module('xlsxwriter') else 'openpyxl'
+    tmp_path = f"{path}.tmp.xlsx"
+    with pd.ExcelWriter(tmp_path, engine=engine) as writer:
+        for name, df in sheets.items():
+            synthetic_sheet(df, rows, rng, coerced.get(name, ())).to_excel(writer, sheet_name=name, index=False)
+    os.replace(tmp_path, path)
+
+def _has_module(name):
+    try:
+        __import__(name)
+        return True
+    except ImportError:
+        return False
+
+def measure(fn, repeat, setup=None):
+    times = []
+    for i in range(repeat):
+        args = setup(i) if setup is not None else ()
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+    return times
+
+def run_size(rows, repeat, seed, app=False):
+    workdir = os.path.join(BENCH_DIR, f"work_{rows}")
+    os.makedirs(workdir, exist_ok=True)
+    path = os.path.join(workdir, EXCEL_FILE)
+    if not os.path.exists(path):
+        print(f"Generando libro sintético de {rows} filas por hoja...", file=sys.stderr)
+        write_workbook(path, rows, seed)
+
+    # Cada tamaño usa su propio cache y almacén dentro de su carpeta
+    cwd = os.getcwd()
+    reset_process_state()
+    os.chdir(workdir)
+    try:
+        schemas = list(get_schemas().values())
+        results = {}
+        results['excel_load'] = measure(lambda: pd.read_excel(EXCEL_FILE, sheet_name=None), repeat)
+        sheets = pd.read_excel(EXCEL_FILE, sheet_name=None)
+
+        raw = lambda i: ([sheets[s.sheet].copy() for s in schemas],)
+        results['coercion'] = measure(lambda dfs: [coerce_numeric_columns(df, s.numeric) for s, df in zip(schemas, dfs)], repeat, raw)
+        normalized = [normalize_sheet_df(sheets[s.sheet].copy(), s)[0] for s in schemas]
+        results['totals'] = measure(lambda: [s.compute_total(df) for s, df in zip(schemas, normalized)], repeat)
+        results['normalize'] = measure(lambda dfs: [normalize_sheet_df(df, s) for s, df in zip(schemas, dfs)], repeat, raw)
+
+        frames = [dpp_frame(df, s)[0] for s, df in zip(schemas, normalized)]
+
+        # Cada repetición guarda una edición masiva (toda una columna editable)
+        # con un escritor nuevo, como una sesión que recién carga la tabla
+        def edited(i):
+            out = []
+            for s, df in zip(schemas, frames):
+                df = df.copy()
+                df[s.editable[0]] = df[s.editable[0]] * (1 + (i + 1) * 1e-3)
+                df['Total'] = s.compute_total(df)
+                out.append(df)
+            return (out,)
+
+        def write(dfs):
+            writer = CacheWriter(delay=3600)
+            for s, df in zip(schemas, dfs):
+                writer.submit((s.unit, s.tipo), df)
+            writer.flush_all()
+
+        results['cache_write'] = measure(write, repeat, edited)
+        results['cache_read'] = measure(lambda: [read_cache_table(s.unit, s.tipo).to_pandas() for s in schemas], repeat)
+
+        def consolidado():
+            deseados = {unit: {tipo: monto_dpp(unit, tipo) for tipo in TIPOS} for unit in UNIT_REGISTRY}
+            return consolidado_tables(deseados, cache_aggregates(list(UNIT_REGISTRY), list(TIPOS)))
+
+        results['consolidado'] = measure(consolidado, repeat)
+        if app:
+            try:
+                results['app_coordinacion'] = measure(lambda: run_app_page("Coordinación", os.path.join(cwd, 'ppt.py')), repeat)
+            except Exception as e:
+                print(f"No se pudo medir la página Coordinación: {e}", file=sys.stderr)
+        return results
+    finally:
+        reset_process_state()
+        os.chdir(cwd)
+
+# Página completa de la app (incluye create_consolidado y el render con Styler)
+# con el probador de Streamlit, sin navegador
+def run_app_page(page, script):
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(script, default_timeout=600)
+    at.run()
+    at.sidebar.selectbox[0].select(page).run()
+    if at.exception:
+        raise RuntimeError(at.exception[0].value)
+
+# Costo de arranque: lo que agrega importar ppt.py sobre streamlit, pandas y
+# pyarrow (que cualquier proceso de la app carga igual), medido con
+# python -X importtime en un proceso nuevo. Los módulos de LAZY_MODULES solo se
+# cargan en las páginas que los usan y no deben aparecer al importar ppt.py.
+STARTUP_IMPORT_BUDGET_MS = 100
+LAZY_MODULES = ('st_aggrid', 'plotly.express', 'openpyxl')
+# Fuera de `streamlit run` el primer elemento recorre la pila para advertir que
+# no hay servidor, lo que no ocurre en la app; se marca como ya advertido.
+IMPORT_PROBE = (
+    "import json, sys, streamlit, pandas, numpy, pyarrow; "
+    "import streamlit.delta_generator as dg; dg._use_warning_has_been_displayed = True; import ppt; "
+    "print(json.dumps([m for m in {lazy!r} if m in sys.modules]))"
+)
+
+def import_cost(module='ppt'):
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', IMPORT_PROBE.format(lazy=LAZY_MODULES).replace('ppt;', f'{module};')],
+                          capture_output=True, text=True, check=True)
+    cumulative = None
+    for line in proc.stderr.splitlines():
+        parts = line.split('|')
+        # Solo la línea del módulo de primer nivel (sin sangría)
+        if line.startswith('import time:') and len(parts) == 3 and parts[2].rstrip() == f" {module}":
+            cumulative = int(parts[1]) / 1e6
+    return cumulative, json.loads(proc.stdout.strip().splitlines()[-1])
+
+def measure_imports(repeat):
+    times, eager = [], []
+    for _ in range(repeat):
+        seconds, eager = import_cost()
+        times.append(seconds)
+    return times, eager
+
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+    return commit, dirty
+
+def resolve_commit(ref):
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', ref], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ref
+
+def load_results(path=RESULTS_FILE):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def record(records, path=RESULTS_FILE):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a', encoding='utf-8') as f:
+        for rec in records:
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+# Último resultado de cada (filas, etapa) para el commit de referencia
+def baseline(history, commit):
+    base = {}
+    for rec in history:
+        if rec['commit'] == commit:
+            base[(rec['rows'], rec['step'])] = rec
+    return base
+
+def report(records, base):
+    table = pd.DataFrame([{
+        'filas': rec['rows'], 'etapa': rec['step'],
+        'mejor (s)': rec['best'], 'mediana (s)': rec['median'],
+        **({'referencia (s)': base[(rec['rows'], rec['step'])]['best'],
+            'relación': rec['best'] / base[(rec['rows'], rec['step'])]['best']}
+           if (rec['rows'], rec['step']) in base else {}),
+    } for rec in records])
+    return table.to_string(index=False, float_format=lambda v: f"{v:.4f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mide la carga, limpieza, totales, cache y consolidado con libros sintéticos.")
+    parser.add_argument('--rows', type=int, action='append', help="filas por hoja; se puede repetir (por defecto 1000, 10000 y 100000)")
+    parser.add_argument('--repeat', type=int, default=3, help="repeticiones por etapa (por defecto %(default)s)")
+    parser.add_argument('--seed', type=int, default=0, help="semilla del generador (por defecto %(default)s)")
+    parser.add_argument('--app', action='store_true', help="medir también la página Coordinación completa con el probador de Streamlit")
+    parser.add_argument('--imports', action='store_true',
+                        help=f"medir el costo de importar ppt.py (presupuesto {STARTUP_IMPORT_BUDGET_MS} ms); solo esto si no se indica --rows")
+    parser.add_argument('--compare', metavar='REF', help="comparar con los resultados guardados de este commit")
+    parser.add_argument('--no-record', action='store_true', help=f"no agregar los resultados a {RESULTS_FILE}")
+    args = parser.parse_args(argv)
+
+    commit, dirty = git_revision()
+    history = load_results()
+    records = []
+
+    def add(rows, step, times):
+        records.append({
+            'commit': commit, 'dirty': dirty, 'fecha': pd.Timestamp.now().isoformat(timespec='seconds'),
+            'rows': rows, 'step': step, 'best': min(times), 'median': statistics.median(times), 'repeat': len(times),
+            'python': platform.python_version(), 'pandas': pd.__version__,
+        })
+
+    status = 0
+    if args.imports:
+        times, eager = measure_imports(args.repeat)
+        add(0, 'import_ppt', times)
+        if min(times) * 1000 > STARTUP_IMPORT_BUDGET_MS:
+            print(f"Importar ppt.py toma {min(times) * 1000:.0f} ms, sobre el presupuesto de {STARTUP_IMPORT_BUDGET_MS} ms.", file=sys.stderr)
+            status = 1
+        if eager:
+            print(f"Módulos que deberían cargarse solo en sus páginas: {', '.join(eager)}", file=sys.stderr)
+            status = 1
+    for rows in args.rows or (() if args.imports else DEFAULT_ROWS):
+        for step, times in run_size(rows, args.repeat, args.seed, args.app).items():
+            add(rows, step, times)
+
+    base = baseline(history, resolve_commit(args.compare)) if args.compare else {}
+    print(report(records, base))
+    if not args.no_record:
+        record(records)
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1532 @@
+import pandas as pd
+import numpy as np
+import os
+import atexit
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+import hashlib
+import json
+import sqlite3
+import tempfile
+import threading
+import logging
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pyarrow as pa
+import pyarrow.feather as feather
+import ppt_metrics as metrics
+try:
+    import fcntl
+except ImportError:  # Windows: solo quedan los candados entre hilos del proceso
+    fcntl = None
+
+# Núcleo de cálculo sin interfaz: lectura y normalización del libro, fórmulas,
+# cache de tablas DPP 2025 y consolidado. Lo usan tanto la app de Streamlit
+# (ppt.py) como el modo por lotes (ppt_batch.py), por eso aquí no se importa
+# streamlit ni se muestran mensajes: los errores se propagan como excepciones.
+
+# Funciones de cálculo con fórmulas corregidas
+# Motor de totales vectorizado: acepta escalares, vectores por fila o matrices
+# (escenarios x filas) y aplica la fórmula con broadcasting de NumPy.
+MISIONES_FORMULA_COLUMNS = ['Costo de Pasaje', 'Alojamiento', 'Per-diem y Otros', 'Movilidad', 'Días', 'Cantidad de Funcionarios']
+CONSULTORIAS_FORMULA_COLUMNS = ['Nº', 'Monto mensual', 'cantidad meses']
+
+def _round_total(total, decimals):
+    return total if decimals is None else np.round(total, decimals)
+
+def misiones_total(pasaje, alojamiento, per_diem, movilidad, dias, funcionarios, decimals=2):
+    pasaje, alojamiento, per_diem, movilidad, dias, funcionarios = (
+        np.asarray(x, dtype=float) for x in (pasaje, alojamiento, per_diem, movilidad, dias, funcionarios)
+    )
+    return _round_total((pasaje + (alojamiento + per_diem + movilidad) * dias) * funcionarios, decimals)
+
+def consultorias_total(numero, monto_mensual, meses, decimals=2):
+    numero, monto_mensual, meses = (np.asarray(x, dtype=float) for x in (numero, monto_mensual, meses))
+    return _round_total(numero * monto_mensual * meses, decimals)
+
+def calculate_total_misiones(df, decimals=2):
+    return misiones_total(*(df[col].to_numpy(dtype=float) for col in MISIONES_FORMULA_COLUMNS), decimals=decimals)
+
+def calculate_total_consultorias(df, decimals=2):
+    return consultorias_total(*(df[col].to_numpy(dtype=float) for col in CONSULTORIAS_FORMULA_COLUMNS), decimals=decimals)
+
+# Conversión numérica de columnas tipo "1,234.5": las columnas ya numéricas solo
+# se rellenan con 0 y las de texto se limpian todas juntas en una sola pasada.
+# Devuelve cuántas celdas no se pudieron convertir por columna.
+def coerce_numeric_columns(df, columns):
+    failures = {}
+    text_columns = []
+    for col in columns:
+        if pd.api.types.is_numeric_dtype(df[col]) and not pd.api.types.is_bool_dtype(df[col]):
+            df[col] = df[col].fillna(0)
+        else:
+            text_columns.append(col)
+    if not text_columns:
+        return failures
+
+    raw = pd.Series(df[text_columns].to_numpy(dtype=object).ravel(order='F'))
+    cleaned = raw.astype(str).str.replace(',', '', regex=False).str.strip()
+    parsed = pd.to_numeric(cleaned, errors='coerce')
+    failed = parsed.isna() & ~(raw.isna() | cleaned.eq(''))
+
+    shape = (len(text_columns), len(df))
+    values = parsed.fillna(0).to_numpy(dtype=float).reshape(shape)
+    failed_counts = failed.to_numpy().reshape(shape).sum(axis=1)
+    for i, col in enumerate(text_columns):
+        df[col] = values[i]
+        if failed_counts[i]:
+            failures[col] = int(failed_counts[i])
+    return failures
+
+def parse_number(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return 0.0, True
+    if isinstance(value, (int, float)):
+        return float(value), True
+    text = str(value).replace(',', '').strip()
+    if not text:
+        return 0.0, True
+    try:
+        return float(text), True
+    except ValueError:
+        return 0.0, False
+
+# Cache de resultados por clave a nivel de proceso, compartido entre sesiones y
+# reruns. Cada clave tiene su propio candado, así que dos hilos que piden la
+# misma clave calculan una sola vez; las excepciones no se guardan.
+class KeyedCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._values = OrderedDict()
+        self._key_locks = {}
+
+    def get(self, key, compute):
+        with self._lock:
+            if key in self._values:
+                self._values.move_to_end(key)
+                return self._values[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                if key in self._values:
+                    return self._values[key]
+            value = compute()
+            with self._lock:
+                self._values[key] = value
+                while len(self._values) > self.max_entries:
+                    old_key, _ = self._values.popitem(last=False)
+                    self._key_locks.pop(old_key, None)
+            return value
+
+    def peek(self, key):
+        with self._lock:
+            return self._values.get(key)
+
+    def put(self, key, value):
+        with self._lock:
+            self._values[key] = value
+            while len(self._values) > self.max_entries:
+                old_key, _ = self._values.popitem(last=False)
+                self._key_locks.pop(old_key, None)
+
+    def keys(self):
+        with self._lock:
+            return list(self._values)
+
+    def discard(self, predicate):
+        with self._lock:
+            for key in [key for key in self._values if predicate(key)]:
+                del self._values[key]
+                self._key_locks.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._key_locks.clear()
+
+# Cache de tablas DPP 2025 en formato Feather (columnar, conserva los tipos y
+# se puede mapear en memoria). Se escribe en un archivo temporal y luego se
+# renombra, de modo que ninguna sesión lee un archivo a medio escribir.
+CACHE_DIR = 'cache'
+
+def cache_path(unidad, tipo, ext='feather'):
+    return f"{CACHE_DIR}/{unidad}_{tipo}_DPP2025.{ext}"
+
+def to_arrow(df):
+    df = df.reset_index(drop=True)
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Columnas con tipos mezclados tras la edición en la grilla
+        mixed = df.select_dtypes(include='object').columns
+        return pa.Table.from_pandas(df.astype({col: str for col in mixed}), preserve_index=False)
+
+def _atomic_write(path, write):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _write_feather(df, path, version):
+    table = to_arrow(df)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), VERSION_METADATA_KEY: str(version).encode()})
+    _atomic_write(path, lambda f: feather.write_feather(table, f, compression='uncompressed'))
+
+# previous es la tabla que había en disco antes de esta escritura; con ella se
+# registran en el historial solo las celdas que cambiaron.
+def _write_cache_file(df, unidad, tipo, version=0, previous=None):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    _write_feather(df, cache_path(unidad, tipo), version)
+    conn = store_connection()
+    with conn:
+        _store_replace_rows(conn, DPP, unidad, tipo, df, _dpp_file_version(unidad, tipo))
+        _append_history(conn, unidad, tipo, version, previous, df)
+
+# Versiones por tabla: cada guardado aceptado incrementa un contador que viaja en
+# los metadatos del propio archivo Feather, así que se reemplaza junto con los
+# datos. Las sesiones guardan indicando la versión sobre la que editaron; si otra
+# sesión guardó antes, se fusionan celda a celda los cambios de ambas y solo las
+# celdas editadas por las dos con valores distintos quedan en conflicto (prevalece
+# lo ya guardado). Entre procesos, la escritura toma un candado de archivo por
+# tabla y repite la fusión si el archivo cambió en disco.
+VERSION_METADATA_KEY = b'dpp_version'
+
+@contextmanager
+def _file_lock(path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(f"{path}.lock", 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def _table_version(table):
+    return int((table.schema.metadata or {}).get(VERSION_METADATA_KEY, b'0'))
+
+def read_cache_version(unidad, tipo):
+    path = cache_path(unidad, tipo)
+    if os.path.exists(path):
+        with pa.memory_map(path) as source:
+            return _table_version(pa.ipc.open_file(source))
+    # Caches CSV de versiones anteriores: versión 0
+    return 0 if os.path.exists(cache_path(unidad, tipo, 'csv')) else None
+
+def _read_disk_frame(unidad, tipo):
+    path = cache_path(unidad, tipo)
+    if os.path.exists(path):
+        table = feather.read_table(path, memory_map=True)
+        return _table_version(table), table.to_pandas()
+    legacy_path = cache_path(unidad, tipo, 'csv')
+    if os.path.exists(legacy_path):
+        return 0, pd.read_csv(legacy_path)
+    return None
+
+def _changed_cells(a, b):
+    a, b = np.asarray(a, dtype=object), np.asarray(b, dtype=object)
+    return ~((a == b) | (pd.isna(a) & pd.isna(b)))
+
+# Fusión a tres vías por posición de fila (las tablas DPP no agregan ni quitan
+# filas). Devuelve (None, None) si las tablas ya no tienen la misma forma.
+def merge_frames(base, ours, theirs, derived=('Total',)):
+    base, ours, theirs = (df.reset_index(drop=True) for df in (base, ours, theirs))
+    if not (base.shape == ours.shape == theirs.shape and base.columns.equals(ours.columns) and base.columns.equals(theirs.columns)):
+        return None, None
+    cells = [col for col in theirs.columns if col not in derived]
+    mine = _changed_cells(base[cells], ours[cells])
+    conflicts = mine & _changed_cells(base[cells], theirs[cells]) & _changed_cells(ours[cells], theirs[cells])
+    take = mine & ~conflicts
+    merged = theirs.copy()
+    for j in np.flatnonzero(take.any(axis=0)):
+        merged.loc[take[:, j], cells[j]] = ours.loc[take[:, j], cells[j]]
+    return merged, int(conflicts.sum())
+
+# Almacén SQLite (modo WAL) con una fila por fila de presupuesto: unidad, país,
+# objetivo, área y Total, indexados para responder totales por cualquiera de
+# esas dimensiones con SQL en lugar de cargar hojas completas. Las tablas DPP 2025
+# ('dpp') se actualizan en la misma escritura del Feather, dentro de una
+# transacción, y las hojas del libro ('requerimiento') al precargarlo. La tabla
+# versiones registra qué versión de cada archivo está cargada; si un archivo
+# cambió por fuera, se vuelve a cargar antes de consultar. Las tablas completas
+# siguen en los Feather, que es lo que necesitan las grillas.
+#
+# La tabla cubos guarda, por fuente, tipo y unidad, la suma y el conteo de filas
+# de cada combinación de dimensiones. Se recalcula solo para la unidad que se
+# reemplaza, en la misma transacción, y los totales por cualquier subconjunto de
+# dimensiones (con filtros para bajar de nivel) se responden sumando el cubo en
+# lugar de agrupar las filas.
+STORE_FILE = f"{CACHE_DIR}/presupuesto.sqlite"
+STORE_SCHEMA_VERSION = 2
+STORE_TABLES = {'Misiones': 'misiones', 'Consultorías': 'consultorias'}
+# Primera columna presente en la hoja para cada dimensión
+STORE_DIMENSIONS = {
+    'pais': ('País',),
+    'objetivo': ('Objetivo',),
+    'area': ('Area imputacion', 'VPD/AREA', 'VPF/AREA', 'PRE/AREA'),
+    'categoria': ('CATEGORÍA',),
+    'subcategoria': ('SUBCATEGORÍA',),
+}
+REQUERIMIENTO = 'requerimiento'
+DPP = 'dpp'
+
+def _store_schema():
+    statements = ["""
+        CREATE TABLE IF NOT EXISTS versiones (
+            fuente TEXT NOT NULL, unidad TEXT NOT NULL, tipo TEXT NOT NULL, version TEXT NOT NULL,
+            PRIMARY KEY (fuente, unidad, tipo)
+        )
+    """]
+    for table in STORE_TABLES.values():
+        statements.append(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                fuente TEXT NOT NULL, unidad TEXT NOT NULL, fila INTEGER NOT NULL,
+                {', '.join(f'{dim} TEXT' for dim in STORE_DIMENSIONS)}, total REAL NOT NULL,
+                PRIMARY KEY (fuente, unidad, fila)
+            ) WITHOUT ROWID
+        """)
+        statements += [f"CREATE INDEX IF NOT EXISTS {table}_{dim} ON {table} (fuente, {dim})" for dim in STORE_DIMENSIONS]
+    statements += [f"""
+        CREATE TABLE IF NOT EXISTS cubos (
+            fuente TEXT NOT NULL, tipo TEXT NOT NULL, unidad TEXT NOT NULL,
+            {', '.join(f'{dim} TEXT' for dim in STORE_DIMENSIONS)}, total REAL NOT NULL, filas INTEGER NOT NULL
+        )
+    """, "CREATE INDEX IF NOT EXISTS cubos_unidad ON cubos (fuente, tipo, unidad)"]
+    return statements + _history_schema()
+
+_store_local = threading.local()
+
+def store_connection():
+    conn = getattr(_store_local, 'conn', None)
+    if conn is None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(STORE_FILE, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with conn:
+            # El almacén se deriva de los archivos: si cambia el esquema se reconstruye.
+            # El historial no se puede derivar, así que nunca se borra.
+            if conn.execute("PRAGMA user_version").fetchone()[0] != STORE_SCHEMA_VERSION:
+                for table in ('versiones', 'cubos', *STORE_TABLES.values()):
+                    conn.execute(f"DROP TABLE IF EXISTS {table}")
+                conn.execute(f"PRAGMA user_version = {STORE_SCHEMA_VERSION}")
+            for statement in _store_schema():
+                conn.execute(statement)
+        _store_local.conn = conn
+    return conn
+
+def _dimension_values(df, candidates):
+    col = next((c for c in candidates if c in df.columns), None)
+    if col is None:
+        return [None] * len(df)
+    values = df[col]
+    return [None if pd.isna(v) else str(v) for v in values]
+
+def _store_replace_rows(conn, fuente, unidad, tipo, df, version):
+    table = STORE_TABLES[tipo]
+    totals = np.nan_to_num(df['Total'].to_numpy(dtype=float)) if 'Total' in df.columns else np.zeros(len(df))
+    rows = zip([fuente] * len(df), [unidad] * len(df), range(len(df)),
+               *(_dimension_values(df, candidates) for candidates in STORE_DIMENSIONS.values()), totals.tolist())
+    placeholders = ', '.join('?' * (4 + len(STORE_DIMENSIONS)))
+    conn.execute(f"DELETE FROM {table} WHERE fuente = ? AND unidad = ?", (fuente, unidad))
+    conn.executemany(f"INSERT INTO {table} VALUES ({placeholders})", rows)
+    _refresh_cube(conn, fuente, unidad, tipo)
+    conn.execute("INSERT OR REPLACE INTO versiones VALUES (?, ?, ?, ?)", (fuente, unidad, tipo, version))
+
+def _refresh_cube(conn, fuente, unidad, tipo):
+    dims = ', '.join(STORE_DIMENSIONS)
+    conn.execute("DELETE FROM cubos WHERE fuente = ? AND tipo = ? AND unidad = ?", (fuente, tipo, unidad))
+    conn.execute(f"""
+        INSERT INTO cubos SELECT fuente, ?, unidad, {dims}, SUM(total), COUNT(*) FROM {STORE_TABLES[tipo]}
+        WHERE fuente = ? AND unidad = ? GROUP BY {dims}
+    """, (tipo, fuente, unidad))
+
+def store_replace(fuente, unidad, tipo, df, version):
+    conn = store_connection()
+    with conn:
+        _store_replace_rows(conn, fuente, unidad, tipo, df, version)
+
+def store_delete(fuente, unidad, tipo):
+    conn = store_connection()
+    with conn:
+        conn.execute(f"DELETE FROM {STORE_TABLES[tipo]} WHERE fuente = ? AND unidad = ?", (fuente, unidad))
+        conn.execute("DELETE FROM cubos WHERE fuente = ? AND tipo = ? AND unidad = ?", (fuente, tipo, unidad))
+        conn.execute("DELETE FROM versiones WHERE fuente = ? AND unidad = ? AND tipo = ?", (fuente, unidad, tipo))
+
+def store_versions(fuente):
+    rows = store_connection().execute("SELECT unidad, tipo, version FROM versiones WHERE fuente = ?", (fuente,))
+    return {(unidad, tipo): version for unidad, tipo, version in rows}
+
+def _dpp_file_version(unidad, tipo):
+    version = read_cache_version(unidad, tipo)
+    if version is None:
+        return None
+    path = cache_path(unidad, tipo)
+    stat = os.stat(path if os.path.exists(path) else cache_path(unidad, tipo, 'csv'))
+    return f"{version}:{stat.st_mtime_ns}:{stat.st_size}"
+
+def refresh_store_dpp(unidades, tipos):
+    stored = store_versions(DPP)
+    for unidad in unidades:
+        for tipo in tipos:
+            version = _dpp_file_version(unidad, tipo)
+            if version == stored.get((unidad, tipo)):
+                continue
+            if version is None:
+                store_delete(DPP, unidad, tipo)
+            else:
+                store_replace(DPP, unidad, tipo, _read_disk_frame(unidad, tipo)[1], version)
+
+CUBE_DIMENSIONS = ('unidad', *STORE_DIMENSIONS)
+
+# Totales agrupados por las dimensiones de `by` (puede ser vacía: total general),
+# sumando el cubo. filters restringe dimensiones a un valor (None o NaN = sin valor);
+# tipo=None suma Misiones y Consultorías.
+def cube_rollup(fuente, by=(), tipo=None, filters=None):
+    by, filters = list(by), dict(filters or {})
+    unknown = [dim for dim in (*by, *filters) if dim not in CUBE_DIMENSIONS]
+    if unknown:
+        raise ValueError(f"Dimensión desconocida: {unknown[0]}")
+    where, params = ["fuente = ?"], [fuente]
+    if tipo is not None:
+        where.append("tipo = ?")
+        params.append(tipo)
+    for dim, value in filters.items():
+        if value is None or pd.isna(value):
+            where.append(f"{dim} IS NULL")
+        else:
+            where.append(f"{dim} = ?")
+            params.append(value)
+    columns = ''.join(f"{dim}, " for dim in by)
+    sql = f"SELECT {columns}SUM(total) AS total, SUM(filas) AS filas FROM cubos WHERE {' AND '.join(where)}"
+    if by:
+        sql += f" GROUP BY {', '.join(by)} ORDER BY total DESC"
+    return pd.read_sql_query(sql, store_connection(), params=params)
+
+def store_totals(fuente, tipo, by='unidad', unidad=None):
+    return cube_rollup(fuente, [by], tipo, None if unidad is None else {'unidad': unidad})
+
+# Agregados para Coordinación: SUM/COUNT por unidad en SQL sobre las tablas DPP
+# guardadas; las ediciones aún no escritas se toman de la memoria.
+@metrics.timed('cache_aggregates')
+def cache_aggregates(unidades, tipos):
+    refresh_store_dpp(unidades, tipos)
+    writer = get_cache_writer()
+    stored = {}
+    for tipo in tipos:
+        totals = store_totals(DPP, tipo)
+        stored.update({(row.unidad, tipo): {'total': float(row.total), 'rows': int(row.filas)} for row in totals.itertuples()})
+    aggregates = {}
+    for unidad in unidades:
+        for tipo in tipos:
+            pending = writer.pending((unidad, tipo))
+            if pending is not None:
+                aggregates[(unidad, tipo)] = {'total': float(pending['Total'].sum()), 'rows': len(pending)}
+            else:
+                aggregates[(unidad, tipo)] = stored.get((unidad, tipo))
+    return aggregates
+
+# Historial de ediciones de las tablas DPP 2025: cada escritura agrega a la
+# tabla cambios solo las celdas que cambiaron (valor anterior y nuevo, en JSON) y
+# cada tanto una foto completa de la tabla en cache/historial. Para reconstruir
+# una versión se parte de la última foto anterior y se aplican los cambios
+# posteriores, que nunca superan HISTORY_SNAPSHOT_CELLS; el Total no se registra
+# porque se recalcula con la fórmula.
+HISTORY_DIR = f"{CACHE_DIR}/historial"
+HISTORY_SNAPSHOT_CELLS = 200
+
+def _history_schema():
+    return ["""
+        CREATE TABLE IF NOT EXISTS cambios (
+            unidad TEXT NOT NULL, tipo TEXT NOT NULL, version INTEGER NOT NULL,
+            fila INTEGER NOT NULL, columna TEXT NOT NULL, anterior TEXT, nuevo TEXT, fecha TEXT NOT NULL
+        )
+    """, "CREATE INDEX IF NOT EXISTS cambios_version ON cambios (unidad, tipo, version)", """
+        CREATE TABLE IF NOT EXISTS snapshots (
+            unidad TEXT NOT NULL, tipo TEXT NOT NULL, version INTEGER NOT NULL, archivo TEXT NOT NULL, fecha TEXT NOT NULL,
+            PRIMARY KEY (unidad, tipo, version)
+        )
+    """]
+
+def snapshot_path(unidad, tipo, version):
+    return f"{HISTORY_DIR}/{unidad}_{tipo}_v{version}.feather"
+
+def _cell_json(value):
+    if pd.isna(value):
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+def _append_history(conn, unidad, tipo, version, previous, df):
+    fecha = pd.Timestamp.now().isoformat(timespec='seconds')
+    cells = [col for col in df.columns if col != 'Total']
+    same_shape = previous is not None and previous.shape == df.shape and previous.columns.equals(df.columns)
+    pending = 0
+    if same_shape:
+        changed = _changed_cells(previous[cells].reset_index(drop=True), df[cells].reset_index(drop=True))
+        filas, cols = np.nonzero(changed)
+        if len(filas) == 0:
+            return
+        before, after = previous[cells].to_numpy(dtype=object), df[cells].to_numpy(dtype=object)
+        conn.executemany("INSERT INTO cambios VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (
+            (unidad, tipo, version, int(i), cells[j], _cell_json(before[i, j]), _cell_json(after[i, j]), fecha)
+            for i, j in zip(filas.tolist(), cols.tolist())
+        ))
+        last = conn.execute("SELECT MAX(version) FROM snapshots WHERE unidad = ? AND tipo = ?", (unidad, tipo)).fetchone()[0]
+        if last is not None:
+            pending = conn.execute("SELECT COUNT(*) FROM cambios WHERE unidad = ? AND tipo = ? AND version > ?",
+                                   (unidad, tipo, last)).fetchone()[0]
+            if pending <= HISTORY_SNAPSHOT_CELLS:
+                return
+    # Primera escritura, cambio de forma o demasiados cambios desde la última foto
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    path = snapshot_path(unidad, tipo, version)
+    _write_feather(df, path, version)
+    metrics.count('history_snapshots')
+    conn.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?)", (unidad, tipo, version, path, fecha))
+
+def history_versions(unidad, tipo):
+    return pd.read_sql_query("""
+        SELECT version, MAX(fecha) AS fecha, SUM(celdas) AS celdas FROM (
+            SELECT version, fecha, 1 AS celdas FROM cambios WHERE unidad = ? AND tipo = ?
+            UNION ALL
+            SELECT version, fecha, 0 AS celdas FROM snapshots WHERE unidad = ? AND tipo = ?
+        ) GROUP BY version ORDER BY version DESC
+    """, store_connection(), params=(unidad, tipo, unidad, tipo))
+
+def _set_cells(df, col, filas, values):
+    try:
+        df.loc[filas, col] = values
+    except (TypeError, ValueError):
+        df[col] = df[col].astype(object)
+        df.loc[filas, col] = values
+
+@metrics.timed('history_restore')
+def table_at_version(unidad, tipo, version):
+    conn = store_connection()
+    snapshot = conn.execute("""
+        SELECT version, archivo FROM snapshots WHERE unidad = ? AND tipo = ? AND version <= ?
+        ORDER BY version DESC LIMIT 1
+    """, (unidad, tipo, version)).fetchone()
+    if snapshot is None or not os.path.exists(snapshot[1]):
+        return None
+    df = feather.read_table(snapshot[1]).to_pandas()
+    deltas = pd.read_sql_query("""
+        SELECT fila, columna, nuevo FROM cambios WHERE unidad = ? AND tipo = ? AND version > ? AND version <= ?
+        ORDER BY version, rowid
+    """, conn, params=(unidad, tipo, snapshot[0], version))
+    # Vale el último valor de cada celda
+    deltas = deltas.drop_duplicates(['fila', 'columna'], keep='last')
+    for col, group in deltas.groupby('columna', sort=False):
+        if col in df.columns:
+            values = [None if v is None else json.loads(v) for v in group['nuevo']]
+            _set_cells(df, col, group['fila'].to_numpy(), values)
+    schema = SCHEMAS.get((unidad, tipo))
+    if schema is not None and 'Total' in df.columns:
+        df['Total'] = schema.compute_total(df)
+    return df
+
+# Diferencias celda a celda entre dos tablas, en formato largo (una fila por
+# celda distinta). Compara las columnas comunes y las filas de ambas.
+def diff_frames(original, current):
+    cols = [col for col in current.columns if col in original.columns]
+    n = min(len(original), len(current))
+    a = original[cols].iloc[:n].to_numpy(dtype=object)
+    b = current[cols].iloc[:n].to_numpy(dtype=object)
+    filas, js = np.nonzero(_changed_cells(a, b))
+    return pd.DataFrame({
+        'fila': filas,
+        'columna': np.asarray(cols, dtype=object)[js],
+        'original': a[filas, js],
+        'actual': b[filas, js],
+    })
+
+# Escritura diferida del cache: una tabla solo se persiste si su contenido cambió
+# respecto de la última versión guardada, y las ediciones seguidas se agrupan en
+# una sola escritura CACHE_FLUSH_DELAY segundos después de la última.
+CACHE_FLUSH_DELAY = 2.0
+
+def frame_digest(df):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr([(str(col), str(dtype)) for col, dtype in df.dtypes.items()]).encode('utf-8'))
+    h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+class CacheWriter:
+    def __init__(self, delay=CACHE_FLUSH_DELAY):
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._heads = {}  # última versión aceptada: (versión, df, digest)
+        self._persisted = {}  # última versión escrita o leída de disco: (versión, df)
+        self._dirty = set()
+        self._timers = {}
+        self._key_locks = {}
+        self._io_locks = {}
+
+    def _lock_for(self, locks, key):
+        with self._lock:
+            return locks.setdefault(key, threading.Lock())
+
+    def _head_entry(self, key):
+        with self._lock:
+            entry = self._heads.get(key)
+        if entry is not None:
+            return entry
+        disk = _read_disk_frame(*key)
+        if disk is None:
+            return None
+        version, df = disk
+        with self._lock:
+            self._persisted.setdefault(key, (version, df))
+            return self._heads.setdefault(key, (version, df, frame_digest(df)))
+
+    def head(self, key):
+        entry = self._head_entry(key)
+        return None if entry is None else (entry[0], entry[1].copy())
+
+    def version(self, key):
+        entry = self._head_entry(key)
+        return None if entry is None else entry[0]
+
+    def pending(self, key):
+        with self._lock:
+            return self._heads[key][1] if key in self._dirty else None
+
+    # Otro proceso reemplazó el archivo: se descarta la versión en memoria para
+    # que la próxima lectura lo tome de disco. Con cambios aún sin escribir no se
+    # toca, porque la escritura ya fusiona con lo que encuentre en disco.
+    def reload(self, key):
+        disk_version = read_cache_version(*key)
+        with self._lock:
+            if key in self._dirty:
+                return False
+            persisted = self._persisted.get(key)
+            if persisted is not None and persisted[0] == disk_version:
+                return False
+            self._heads.pop(key, None)
+            self._persisted.pop(key, None)
+            return True
+
+    def _merge(self, key, base, ours, theirs):
+        merged, conflicts = merge_frames(base, ours, theirs)
+        schema = SCHEMAS.get(key)
+        if merged is not None and schema is not None and 'Total' in merged.columns:
+            merged['Total'] = schema.compute_total(merged)
+        return merged, conflicts
+
+    @metrics.timed('save_to_cache')
+    def submit(self, key, df, base_version=None, base_df=None):
+        with self._lock_for(self._key_locks, key):
+            head = self._head_entry(key)
+            digest = frame_digest(df)
+            merged, conflicts = df, 0
+            if head is not None and base_version is not None and base_version != head[0]:
+                merged, conflicts = self._merge(key, base_df, df, head[1])
+                metrics.count('saves_merged')
+                if merged is None:
+                    return {'saved': False, 'version': head[0], 'df': head[1].copy(), 'conflicts': None}
+                digest = frame_digest(merged)
+            if head is not None and head[2] == digest:
+                metrics.count('saves_unchanged')
+                return {'saved': False, 'version': head[0], 'df': None if merged is df else merged.copy(), 'conflicts': conflicts}
+
+            version = (head[0] if head is not None else 0) + 1
+            with self._lock:
+                if head is None and base_df is not None:
+                    # Tabla nueva, sin archivo en disco: la tabla de partida de la
+                    # sesión es la base de la fusión si otro proceso la escribe antes
+                    self._persisted.setdefault(key, (0, base_df.copy()))
+                self._heads[key] = (version, merged.copy(), digest)
+                self._dirty.add(key)
+                timer = self._timers.pop(key, None)
+                if timer is not None:
+                    timer.cancel()
+                timer = threading.Timer(self.delay, self.flush, args=(key,))
+                timer.daemon = True
+                self._timers[key] = timer
+                timer.start()
+        return {'saved': True, 'version': version, 'df': None if merged is df else merged.copy(), 'conflicts': conflicts}
+
+    @metrics.timed('cache_flush')
+    def flush(self, key):
+        with self._lock_for(self._io_locks, key):
+            with self._lock:
+                if key not in self._dirty:
+                    return
+                entry = self._heads[key]
+                persisted = self._persisted.get(key)
+            version, df, digest = entry
+            with _file_lock(cache_path(*key)):
+                disk_version = read_cache_version(*key)
+                if disk_version is not None and (persisted is None or disk_version != persisted[0]):
+                    # Otro proceso guardó esta tabla desde la última lectura
+                    disk_df = _read_disk_frame(*key)[1]
+                    merged, conflicts = self._merge(key, disk_df if persisted is None else persisted[1], df, disk_df)
+                    if merged is None:
+                        logging.warning("La tabla %s cambió de forma en otro proceso; se descartan los cambios locales.", key)
+                        merged = disk_df
+                    elif conflicts:
+                        logging.warning("Tabla %s: %d celdas en conflicto con otro proceso; prevalece lo guardado.", key, conflicts)
+                    df, version, digest = merged, max(version, disk_version) + 1, frame_digest(merged)
+                    previous = disk_df
+                else:
+                    previous = None if persisted is None or disk_version is None else persisted[1]
+                _write_cache_file(df, *key, version, previous)
+                metrics.count('cache_writes')
+            with self._lock:
+                if self._heads.get(key) is entry:
+                    self._heads[key] = (version, df, digest)
+                    self._persisted[key] = (version, df)
+                    self._dirty.discard(key)
+                    self._timers.pop(key, None)
+                else:
+                    # Llegó otra edición mientras se escribía y queda pendiente. Si
+                    # hubo fusión con disco, la siguiente escritura la repite sobre
+                    # lo recién escrito tomando como base la versión que editó.
+                    self._persisted[key] = (version, df) if df is entry[1] else (entry[0], entry[1])
+
+    def flush_all(self):
+        with self._lock:
+            keys = list(self._dirty)
+            for key in keys:
+                timer = self._timers.pop(key, None)
+                if timer is not None:
+                    timer.cancel()
+        for key in keys:
+            self.flush(key)
+
+_cache_writer = None
+_cache_writer_lock = threading.Lock()
+
+def get_cache_writer():
+    global _cache_writer
+    with _cache_writer_lock:
+        if _cache_writer is None:
+            _cache_writer = CacheWriter()
+            atexit.register(_cache_writer.flush_all)
+        return _cache_writer
+
+# Estado del proceso ligado a la carpeta de trabajo (las rutas del cache y del
+# almacén son relativas): escribe lo pendiente, cierra la conexión SQLite de
+# este hilo y vacía los caches en memoria. Lo usa el benchmark al pasar de un
+# libro sintético a otro.
+def reset_process_state():
+    global _cache_writer
+    with _cache_writer_lock:
+        if _cache_writer is not None:
+            _cache_writer.flush_all()
+            _cache_writer = None
+    conn = getattr(_store_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _store_local.conn = None
+    for cache in (_workbooks, _sheet_digests, _normalized_sheets, _excel_dpp_frames, _sheet_views, _column_sums):
+        cache.clear()
+
+# Función para guardar datos en cache. base_version/base_df son la versión y la
+# tabla sobre las que editó la sesión; el resultado indica la versión aceptada y,
+# si hubo que fusionar, la tabla resultante y las celdas en conflicto.
+def save_to_cache(df, unidad, tipo, base_version=None, base_df=None):
+    return get_cache_writer().submit((unidad, tipo), df, base_version, base_df)
+
+def read_cache_table(unidad, tipo, columns=None):
+    pending = get_cache_writer().pending((unidad, tipo))
+    if pending is not None:
+        return pa.Table.from_pandas(pending if columns is None else pending[columns], preserve_index=False)
+    path = cache_path(unidad, tipo)
+    if os.path.exists(path):
+        return feather.read_table(path, columns=columns, memory_map=True)
+    # Caches CSV de versiones anteriores
+    legacy_path = cache_path(unidad, tipo, 'csv')
+    if os.path.exists(legacy_path):
+        return pa.Table.from_pandas(pd.read_csv(legacy_path, usecols=columns), preserve_index=False)
+    return None
+
+def load_versioned(unidad, tipo):
+    return get_cache_writer().head((unidad, tipo))
+
+def load_from_cache(unidad, tipo):
+    head = load_versioned(unidad, tipo)
+    return None if head is None else head[1]
+
+# Lectura del libro Excel: todas las hojas se parsean en una sola pasada y se
+# comparten entre sesiones y reruns. La clave incluye mtime y tamaño del
+# archivo, de modo que al reemplazar el Excel se vuelve a leer automáticamente.
+EXCEL_FILE = 'BDD_Ajuste.xlsx'
+
+_workbooks = KeyedCache(max_entries=2)
+
+@metrics.timed('read_excel')
+def _read_excel(file_path):
+    return pd.read_excel(file_path, sheet_name=None)
+
+def read_workbook(file_path, mtime_ns, size):
+    return _workbooks.get((file_path, mtime_ns, size), lambda: _read_excel(file_path))
+
+def workbook_version(file_path=EXCEL_FILE):
+    stat = os.stat(file_path)
+    return file_path, stat.st_mtime_ns, stat.st_size
+
+# Digest del contenido de cada hoja, para saber cuáles cambiaron entre dos
+# versiones del libro
+_sheet_digests = KeyedCache(max_entries=2)
+
+def sheet_digests(file_path, mtime_ns, size):
+    return _sheet_digests.get((file_path, mtime_ns, size), lambda: {
+        name: frame_digest(df) for name, df in read_workbook(file_path, mtime_ns, size).items()
+    })
+
+# Registro declarativo de unidades y hojas. Agregar una unidad es solo
+# configuración: su monto DPP 2025 y, por cada tipo, las columnas requeridas y
+# la fórmula del Total. Las columnas numéricas, editables y los formatos se
+# derivan de la fórmula al compilar el registro (una sola vez por proceso).
+MISIONES_INPUT_COLUMNS = ['Cantidad de Funcionarios', 'Días', 'Costo de Pasaje', 'Alojamiento', 'Per-diem y Otros', 'Movilidad']
+CONSULTORIAS_INPUT_COLUMNS = ['Nº', 'Monto mensual', 'cantidad meses']
+VPE_COLUMNS = ['ÍTEM PRESUPUESTO', 'OFICINA', 'UNID. ORG.', 'ACCIONES', 'CATEGORÍA', 'SUBCATEGORÍA', 'Suma de MONTO']
+COUNT_COLUMNS = {'Cantidad de Funcionarios', 'Días', 'Nº', 'cantidad meses'}
+
+TIPOS = {
+    'Misiones': {'sheet_prefix': 'Misiones', 'key': 'Misiones'},
+    'Consultorías': {'sheet_prefix': 'Consultores', 'key': 'Consultorias'},
+}
+
+# deseados=None: el Monto DPP 2025 es la suma del Total de las hojas de la unidad
+UNIT_REGISTRY = {
+    'VPO': {
+        'deseados': {'Misiones': 434707.0, 'Consultorías': 547700.0},
+        'Misiones': {'required': ['País', *MISIONES_INPUT_COLUMNS, 'Total', 'Objetivo'], 'formula': 'misiones'},
+        'Consultorías': {'required': ['Cargo', *CONSULTORIAS_INPUT_COLUMNS, 'Total', 'Observaciones', 'Objetivo', 'tipo'], 'formula': 'consultorias'},
+    },
+    'VPD': {
+        'deseados': {'Misiones': 168000.0, 'Consultorías': 130000.0},
+        'Misiones': {'required': ['País', *MISIONES_INPUT_COLUMNS, 'Total'], 'formula': 'misiones'},
+        'Consultorías': {'required': ['Cargo', 'VPD/AREA', *CONSULTORIAS_INPUT_COLUMNS, 'Total'], 'formula': 'consultorias'},
+    },
+    'VPE': {
+        'deseados': {'Misiones': 28000.0, 'Consultorías': 179400.0},
+        'Misiones': {'required': VPE_COLUMNS, 'formula': 'monto'},
+        'Consultorías': {'required': VPE_COLUMNS, 'formula': 'monto'},
+    },
+    'VPF': {
+        'deseados': {'Misiones': 138600.0, 'Consultorías': 170000.0},
+        'Misiones': {'required': ['País', *MISIONES_INPUT_COLUMNS, 'Total'], 'formula': 'misiones'},
+        'Consultorías': {'required': ['Cargo', 'VPF/AREA', *CONSULTORIAS_INPUT_COLUMNS, 'Total'], 'formula': 'consultorias'},
+    },
+    'PRE': {
+        'deseados': None,
+        'Misiones': {'required': ['País', 'Operación', 'PRE o VP', *MISIONES_INPUT_COLUMNS, 'Total', 'Area imputacion'], 'formula': 'misiones'},
+        'Consultorías': {'required': ['Cargo', 'PRE/AREA', *CONSULTORIAS_INPUT_COLUMNS, 'Total', 'Area imputacion'], 'formula': 'consultorias'},
+    },
+}
+
+FORMULAS = {
+    'misiones': {
+        'inputs': MISIONES_INPUT_COLUMNS,
+        'compute': calculate_total_misiones,
+        'kernel': misiones_total,
+        'args': MISIONES_FORMULA_COLUMNS,
+        'js': """
+            function(params) {
+                return Math.round(
+                    (Number(params.data['Costo de Pasaje']) +
+                    (Number(params.data['Alojamiento']) + Number(params.data['Per-diem y Otros']) + Number(params.data['Movilidad'])) *
+                    Number(params.data['Días'])) *
+                    Number(params.data['Cantidad de Funcionarios'])
+                * 100) / 100;
+            }
+        """,
+    },
+    'consultorias': {
+        'inputs': CONSULTORIAS_INPUT_COLUMNS,
+        'compute': calculate_total_consultorias,
+        'kernel': consultorias_total,
+        'args': CONSULTORIAS_FORMULA_COLUMNS,
+        'js': """
+            function(params) {
+                return Math.round(
+                    Number(params.data['Nº']) * Number(params.data['Monto mensual']) * Number(params.data['cantidad meses'])
+                * 100) / 100;
+            }
+        """,
+    },
+    # El Total es directamente el monto de la hoja
+    'monto': {
+        'inputs': ['Suma de MONTO'],
+        'compute': lambda df, decimals=2: _round_total(df['Suma de MONTO'].to_numpy(dtype=float), decimals),
+        'kernel': lambda monto, decimals=2: _round_total(np.asarray(monto, dtype=float), decimals),
+        'args': ['Suma de MONTO'],
+        'js': None,
+    },
+}
+
+@dataclass(frozen=True)
+class SheetSchema:
+    unit: str
+    tipo: str
+    sheet: str
+    required: tuple
+    numeric: tuple
+    editable: tuple
+    formula: str
+    formats: dict
+
+    @property
+    def page_key(self):
+        return f"{self.unit}_{TIPOS[self.tipo]['key']}_page"
+
+    def missing_columns(self, df):
+        return [col for col in self.required if col not in df.columns]
+
+    @metrics.timed('totals')
+    def compute_total(self, df, decimals=2):
+        return FORMULAS[self.formula]['compute'](df, decimals=decimals)
+
+def compile_schema(unit, tipo, spec):
+    formula = FORMULAS[spec['formula']]
+    editable = tuple(formula['inputs'])
+    # El Total calculado por fórmula también se limpia; con 'monto' se deriva del monto
+    numeric = editable + (('Total',) if formula['js'] else ())
+    columns = list(dict.fromkeys([*spec['required'], 'Total']))
+    formats = {col: "{:.0f}" if col in COUNT_COLUMNS else "{:,.2f}" for col in columns if col in numeric or col == 'Total'}
+
+    return SheetSchema(
+        unit=unit,
+        tipo=tipo,
+        sheet=spec.get('sheet', f"{TIPOS[tipo]['sheet_prefix']}_{unit}"),
+        required=tuple(spec['required']),
+        numeric=numeric,
+        editable=editable,
+        formula=spec['formula'],
+        formats=formats,
+    )
+
+SCHEMAS = {
+    (unit, tipo): compile_schema(unit, tipo, config[tipo])
+    for unit, config in UNIT_REGISTRY.items()
+    for tipo in TIPOS
+}
+
+def get_schemas():
+    return SCHEMAS
+
+# Normalización de hojas, separada de la interfaz: valida columnas, limpia las
+# numéricas y calcula el Total. Se usa tanto en las páginas como en la precarga.
+class SchemaError(ValueError):
+    pass
+
+def normalize_sheet_df(df, schema):
+    missing = schema.missing_columns(df)
+    if missing:
+        raise SchemaError(f"La columna '{missing[0]}' no existe en la hoja '{schema.sheet}'.")
+
+    failures = coerce_numeric_columns(df, schema.numeric)
+    if schema.formula == 'monto' or 'Total' not in df.columns or df['Total'].sum() == 0:
+        df['Total'] = schema.compute_total(df)
+    return df, failures
+
+# Tabla DPP 2025: columnas numéricas como float y Total siempre recalculado por
+# fórmula (la hoja puede traer un Total desactualizado)
+def dpp_frame(df, schema):
+    df, failures = normalize_sheet_df(df.reset_index(drop=True), schema)
+    df = df.astype({col: float for col in schema.numeric})
+    df['Total'] = schema.compute_total(df)
+    return df, failures
+
+def normalize_consolidado_df(df):
+    numeric_cols = df.select_dtypes(include=['float', 'int']).columns.tolist()
+    for col in numeric_cols:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    # Redondear a una decimal
+    df[numeric_cols] = df[numeric_cols].round(1)
+    return df
+
+CONSOLIDADO_SHEETS = ['consolidadoV2', 'Consolidado']
+
+# Hojas normalizadas por versión del libro, compartidas entre sesiones. El
+# cache serializa el cálculo por clave, así que una página que pide una hoja que
+# la precarga está procesando espera ese mismo resultado en lugar de repetirlo.
+_normalized_sheets = KeyedCache(max_entries=32)
+
+@metrics.timed('normalize_sheet')
+def _normalize_sheet(file_path, mtime_ns, size, sheet_name):
+    sheets = read_workbook(file_path, mtime_ns, size)
+    if sheet_name not in sheets:
+        raise ValueError(f"Worksheet named '{sheet_name}' not found")
+    df = sheets[sheet_name].copy()
+    schemas = {schema.sheet: schema for schema in get_schemas().values()}
+    if sheet_name in schemas:
+        return normalize_sheet_df(df, schemas[sheet_name])
+    return normalize_consolidado_df(df), {}
+
+def normalized_sheet(file_path, mtime_ns, size, sheet_name):
+    key = (file_path, mtime_ns, size, sheet_name)
+    return _normalized_sheets.get(key, lambda: _normalize_sheet(*key))
+
+def load_normalized_sheet(sheet_name, file_path=EXCEL_FILE):
+    df, failures = normalized_sheet(*workbook_version(file_path), sheet_name)
+    return df.copy(), failures
+
+# Tabla DPP 2025 tal como sale del libro, para comparar con la editada
+_excel_dpp_frames = KeyedCache(max_entries=16)
+
+def excel_dpp_frame(schema, file_path=EXCEL_FILE):
+    version = workbook_version(file_path)
+    return _excel_dpp_frames.get((*version, schema.unit, schema.tipo),
+                                 lambda: dpp_frame(normalized_sheet(*version, schema.sheet)[0].copy(), schema)[0])
+
+# Paginación del lado del servidor: el filtro de texto y el orden se resuelven
+# en pandas sobre la hoja normalizada compartida, y solo se guarda el orden de
+# filas resultante por (versión, hoja, orden, filtro). Cada página es un corte
+# de ese orden, así que lo que viaja al navegador no depende del tamaño de la hoja.
+_sheet_views = KeyedCache(max_entries=16)
+
+def text_filter_mask(df, query):
+    query = query.strip()
+    if not query:
+        return np.ones(len(df), dtype=bool)
+    return np.logical_or.reduce([
+        df[col].astype(str).str.contains(query, case=False, regex=False).to_numpy(dtype=bool)
+        for col in df.columns
+    ])
+
+def sheet_view(sheet_name, sort_by=None, ascending=True, query='', file_path=EXCEL_FILE):
+    version = workbook_version(file_path)
+
+    def compute():
+        df, _ = normalized_sheet(*version, sheet_name)
+        view = df.reset_index(drop=True)[text_filter_mask(df, query)]
+        if sort_by is not None:
+            view = view.sort_values(sort_by, ascending=ascending, kind='stable', na_position='last')
+        return view.index.to_numpy()
+
+    return _sheet_views.get((*version, sheet_name, sort_by, ascending, query.strip()), compute)
+
+@metrics.timed('sheet_page')
+def sheet_page(sheet_name, page, page_size, sort_by=None, ascending=True, query='', file_path=EXCEL_FILE):
+    df, _ = normalized_sheet(*workbook_version(file_path), sheet_name)
+    positions = sheet_view(sheet_name, sort_by, ascending, query, file_path)
+    rows = positions[page * page_size:(page + 1) * page_size]
+    return df.iloc[rows].reset_index(drop=True), len(positions)
+
+# Carga de las hojas del libro en el almacén ('requerimiento'). La versión de
+# cada unidad es el digest de su hoja, así que al reemplazar el libro solo se
+# recargan las hojas que cambiaron.
+def sync_store_workbook(file_path=EXCEL_FILE):
+    version = workbook_version(file_path)
+    digests = sheet_digests(*version)
+    stored = store_versions(REQUERIMIENTO)
+    for (unidad, tipo), schema in get_schemas().items():
+        tag = digests.get(schema.sheet)
+        if tag is not None and stored.get((unidad, tipo)) == tag:
+            continue
+        try:
+            df, _ = normalized_sheet(*version, schema.sheet)
+        except (ValueError, SchemaError) as e:
+            logging.warning("No se pudo cargar la hoja '%s' en el almacén: %s", schema.sheet, e)
+            store_delete(REQUERIMIENTO, unidad, tipo)
+            continue
+        store_replace(REQUERIMIENTO, unidad, tipo, df, tag)
+
+# Precarga en segundo plano: en la primera llamada del proceso se parsea el
+# libro y se normalizan todas las hojas de unidades y de consolidado en un pool
+# de hilos, de modo que las páginas encuentran los resultados ya publicados.
+# La app la llama al empezar cada rerun, y Streamlit solo ejecuta el script
+# cuando se conecta una sesión, así que la primera sesión del proceso paga el
+# calentamiento (su página espera la misma lectura, no la repite); las
+# siguientes ya encuentran el libro listo.
+PRELOAD_WORKERS = 4
+
+_preloads = {}
+_preload_lock = threading.Lock()
+
+def preload_sheet_names():
+    return [schema.sheet for schema in get_schemas().values()] + CONSOLIDADO_SHEETS
+
+def start_preload(file_path=EXCEL_FILE):
+    with _preload_lock:
+        if file_path in _preloads:
+            return _preloads[file_path]
+        executor = ThreadPoolExecutor(max_workers=PRELOAD_WORKERS, thread_name_prefix='preload')
+
+        def run():
+            version = workbook_version(file_path)
+            sheets = read_workbook(*version)
+            futures = {
+                executor.submit(normalized_sheet, *version, name): name
+                for name in preload_sheet_names() if name in sheets
+            }
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    logging.warning("No se pudo precargar la hoja '%s': %s", futures[future], future.exception())
+            sync_store_workbook(file_path)
+
+        _preloads[file_path] = executor.submit(run)
+        return _preloads[file_path]
+
+# Lectura por bloques: openpyxl en modo solo lectura recorre la hoja fila a fila
+# sin cargar el modelo de objetos completo, y se arman DataFrames de a
+# INGEST_CHUNK_ROWS filas (solo con las columnas pedidas). La limpieza y el Total
+# se aplican por bloque y se acumulan totales, filas y celdas no numéricas, de
+# modo que la memoria no depende del tamaño de la hoja. La tabla completa solo
+# se arma cuando una grilla la necesita (load_normalized_sheet).
+INGEST_CHUNK_ROWS = 5000
+
+def iter_sheet_chunks(file_path, sheet_name, chunk_rows=INGEST_CHUNK_ROWS, columns=None):
+    import openpyxl  # solo lo necesita la lectura por bloques
+    wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        if sheet_name not in wb.sheetnames:
+            raise ValueError(f"Worksheet named '{sheet_name}' not found")
+        rows = wb[sheet_name].iter_rows(values_only=True)
+        header = [f"Unnamed: {i}" if h is None else h for i, h in enumerate(next(rows, ()))]
+        if columns is None:
+            positions = list(range(len(header)))
+        else:
+            missing = [col for col in columns if col not in header]
+            if missing:
+                raise SchemaError(f"La columna '{missing[0]}' no existe en la hoja '{sheet_name}'.")
+            positions = [header.index(col) for col in columns]
+        names = [header[i] for i in positions]
+
+        chunk = []
+        emitted = False
+        for row in rows:
+            if all(v is None for v in row):
+                continue
+            chunk.append([row[i] if i < len(row) else None for i in positions])
+            if len(chunk) == chunk_rows:
+                yield pd.DataFrame.from_records(chunk, columns=names)
+                chunk = []
+                emitted = True
+        if chunk or not emitted:
+            yield pd.DataFrame.from_records(chunk, columns=names)
+    finally:
+        wb.close()
+
+@metrics.timed('stream_sheet')
+def stream_sheet(schema, file_path=EXCEL_FILE, chunk_rows=INGEST_CHUNK_ROWS, sink=None):
+    aggregate = {'total': 0.0, 'rows': 0, 'failures': {}}
+    for chunk in iter_sheet_chunks(file_path, schema.sheet, chunk_rows):
+        chunk, failures = dpp_frame(chunk, schema)
+        aggregate['total'] += float(chunk['Total'].sum())
+        aggregate['rows'] += len(chunk)
+        for col, n in failures.items():
+            aggregate['failures'][col] = aggregate['failures'].get(col, 0) + n
+        if sink is not None:
+            sink(chunk)
+    return aggregate
+
+# Suma de una columna por versión del libro. Si el libro ya está parseado (p. ej.
+# por la precarga) se usa esa copia; si no, se recorre solo esa columna por bloques.
+_column_sums = KeyedCache(max_entries=32)
+
+def sheet_column_sum(sheet_name, column, file_path=EXCEL_FILE):
+    version = workbook_version(file_path)
+
+    def compute():
+        sheets = _workbooks.peek(version)
+        chunks = [sheets[sheet_name][[column]].copy()] if sheets is not None and sheet_name in sheets else \
+            iter_sheet_chunks(file_path, sheet_name, columns=[column])
+        total = 0.0
+        for chunk in chunks:
+            coerce_numeric_columns(chunk, [column])
+            total += float(chunk[column].sum())
+        return total
+
+    return _column_sums.get((*version, sheet_name, column), compute)
+
+# Monto DPP 2025 de una unidad/tipo; para PRE es la suma del Total de su hoja
+def monto_dpp(unit, tipo, file_path=EXCEL_FILE):
+    deseados = UNIT_REGISTRY[unit]['deseados']
+    if deseados is not None:
+        return deseados[tipo]
+    return sheet_column_sum(get_schemas()[(unit, tipo)].sheet, 'Total', file_path)
+
+# Tablas de Coordinación por tipo: Actual, Monto DPP 2025 y Ajuste por unidad.
+# aggregates[(unidad, tipo)] es None cuando la unidad todavía no tiene tabla.
+def consolidado_tables(deseados, aggregates):
+    tables = {}
+    for tipo in TIPOS:
+        rows = []
+        for unidad in UNIT_REGISTRY:
+            aggregate = aggregates.get((unidad, tipo))
+            actual = aggregate['total'] if aggregate is not None else 0
+            deseado = deseados[unidad][tipo]
+            rows.append({
+                'Unidad Organizacional': unidad,
+                f"{tipo} - Actual": actual,
+                f"{tipo} - Monto DPP 2025": deseado,
+                f"{tipo} - Ajuste": deseado - actual,
+            })
+        tables[tipo] = pd.DataFrame(rows)
+    return tables
+
+# Exportación XLSX del paquete DPP 2025: una hoja por unidad y tipo (la tabla
+# guardada o, si la unidad aún no tiene, la que sale del libro) y el resumen de
+# Coordinación calculado con esas mismas tablas. Se escribe con xlsxwriter en
+# modo constant_memory, que vuelca cada fila al disco al escribirla, y el archivo
+# queda en EXPORT_DIR con un nombre derivado de la versión del libro y de cada
+# tabla: mientras nada cambie, se reutiliza (también entre procesos).
+EXPORT_DIR = f"{CACHE_DIR}/export"
+EXPORT_KEEP = 4
+XLSX_FORMATS = {"{:.0f}": '0', "{:,.2f}": '#,##0.00', "{:,.1f}": '#,##0.0'}
+
+def sheet_name(unidad, tipo):
+    return f"{unidad}_{TIPOS[tipo]['key']}"
+
+def _xlsx_cell(value):
+    if value is None or value is pd.NA or (isinstance(value, float) and value != value):
+        return None
+    return value
+
+def write_xlsx(tables, path, formats=None):
+    import xlsxwriter  # solo lo necesita la exportación
+    formats = formats or {}
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    try:
+        header = workbook.add_format({'bold': True})
+        cell_formats = {fmt: workbook.add_format({'num_format': fmt}) for fmt in set(XLSX_FORMATS.values())}
+        for name, df in tables.items():
+            worksheet = workbook.add_worksheet(name[:31])
+            # En constant_memory el formato por columna se fija antes de escribir filas
+            for j, col in enumerate(df.columns):
+                fmt = formats.get(name, {}).get(col)
+                if fmt in XLSX_FORMATS:
+                    worksheet.set_column(j, j, None, cell_formats[XLSX_FORMATS[fmt]])
+            worksheet.write_row(0, 0, [str(col) for col in df.columns], header)
+            columns = [df[col].tolist() for col in df.columns]
+            for i, row in enumerate(zip(*columns), start=1):
+                worksheet.write_row(i, 0, [_xlsx_cell(v) for v in row])
+    finally:
+        workbook.close()
+
+def dpp_package_version(file_path=EXCEL_FILE):
+    writer = get_cache_writer()
+    versions = tuple((key, writer.version(key)) for key in SCHEMAS)
+    return hashlib.blake2b(repr((workbook_version(file_path)[1:], versions)).encode(), digest_size=12).hexdigest()
+
+def dpp_package_tables(file_path=EXCEL_FILE):
+    tables, formats = {}, {}
+    for (unidad, tipo), schema in SCHEMAS.items():
+        df = load_from_cache(unidad, tipo)
+        if df is None:
+            df = excel_dpp_frame(schema, file_path)
+        name = sheet_name(unidad, tipo)
+        tables[name], formats[name] = df, schema.formats
+    # Mismos agregados que la página de Coordinación: una unidad sin tabla DPP
+    # guardada cuenta como 0 aunque su hoja se exporte con los valores del libro
+    aggregates = cache_aggregates(list(UNIT_REGISTRY), list(TIPOS))
+    deseados = {unidad: {tipo: monto_dpp(unidad, tipo, file_path) for tipo in TIPOS} for unidad in UNIT_REGISTRY}
+    for tipo, table in consolidado_tables(deseados, aggregates).items():
+        name = f"Coordinacion_{TIPOS[tipo]['key']}"
+        tables[name] = table
+        formats[name] = {col: "{:,.1f}" for col in table.columns[1:]}
+    return tables, formats
+
+def _build_package(path, file_path):
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    tables, formats = dpp_package_tables(file_path)
+    _atomic_write(path, lambda f: write_xlsx(tables, f, formats))
+    # Se conservan solo las últimas exportaciones
+    old = sorted((os.path.join(EXPORT_DIR, f) for f in os.listdir(EXPORT_DIR) if f.endswith('.xlsx')), key=os.path.getmtime)
+    for stale in old[:-EXPORT_KEEP]:
+        for leftover in (stale, f"{stale}.lock"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+# Ruta del XLSX para la versión actual de los datos; se genera solo si no existe
+@metrics.timed('export_xlsx')
+def dpp_package_xlsx(file_path=EXCEL_FILE):
+    path = f"{EXPORT_DIR}/presupuesto_DPP2025_{dpp_package_version(file_path)}.xlsx"
+    with _file_lock(path):
+        if not os.path.exists(path):
+            _build_package(path, file_path)
+    return path
+
+# Vigilancia de archivos: un hilo por proceso detecta cuándo se reemplaza el
+# libro o cuándo otro proceso (u otra sesión) escribe una tabla en cache/, e
+# invalida solo lo afectado. Del libro se comparan los digests de cada hoja con
+# los de la versión anterior: los resultados de las hojas sin cambios (hoja
+# normalizada, vistas, sumas, tabla DPP del libro) pasan a la nueva versión y el
+# almacén solo recarga las hojas que cambiaron. De cache/ se relee la tabla de
+# la unidad y se actualiza su cubo. Cada cambio se publica con un número de
+# secuencia; las sesiones consultan los posteriores al último que vieron. Con
+# watchdog (inotify en Linux) el hilo despierta con los eventos del sistema de
+# archivos; sin él, o con PPT_WATCH=poll, revisa cada WATCH_POLL_INTERVAL
+# segundos. PPT_WATCH=off lo desactiva.
+WATCH_MODE = os.environ.get('PPT_WATCH', 'auto')
+WATCH_POLL_INTERVAL = 2.0
+WATCH_IDLE_INTERVAL = 30.0  # revisión de respaldo cuando hay eventos del sistema
+WATCH_SETTLE = 0.2  # agrupa ráfagas de eventos, p. ej. un guardado de Excel
+WATCH_EVENTS_KEEP = 256
+WATCH_IGNORED_EVENTS = ('opened', 'closed_no_write')
+
+_changes = deque(maxlen=WATCH_EVENTS_KEEP)
+_changes_lock = threading.Lock()
+_change_seq = 0
+
+# kind es 'excel' (cambió una hoja del libro) o 'dpp' (cambió una tabla en
+# cache/); unidad y tipo quedan en None para las hojas de consolidado.
+def publish_change(kind, unidad=None, tipo=None, sheet=None, version=None):
+    global _change_seq
+    with _changes_lock:
+        _change_seq += 1
+        _changes.append({'seq': _change_seq, 'kind': kind, 'unidad': unidad, 'tipo': tipo, 'sheet': sheet, 'version': version})
+    metrics.count(f"watch_{kind}")
+
+def change_seq():
+    with _changes_lock:
+        return _change_seq
+
+def changes_since(seq):
+    with _changes_lock:
+        return _change_seq, [event for event in _changes if event['seq'] > seq]
+
+def _carry_over(cache, old, new, unchanged):
+    n = len(old)
+    for key in cache.keys():
+        if key[:n] == old and unchanged(key[n:]):
+            value = cache.peek(key)
+            if value is not None:
+                cache.put((*new, *key[n:]), value)
+    cache.discard(lambda key: key[:n] == old)
+
+@metrics.timed('watch_workbook')
+def workbook_replaced(old, old_digests, new, new_digests):
+    changed = {name for name in old_digests.keys() | new_digests.keys() if old_digests.get(name) != new_digests.get(name)}
+    for cache in (_normalized_sheets, _sheet_views, _column_sums):
+        _carry_over(cache, old, new, lambda rest: rest[0] not in changed)
+    _carry_over(_excel_dpp_frames, old, new, lambda rest: get_schemas()[rest].sheet not in changed)
+    for cache in (_workbooks, _sheet_digests):
+        cache.discard(lambda key: key == old)
+    if not changed:
+        return changed
+    sync_store_workbook(new[0])
+    schemas = {}
+    for schema in get_schemas().values():
+        schemas.setdefault(schema.sheet, []).append(schema)
+    for sheet in sorted(changed):
+        for schema in schemas.get(sheet, [None]):
+            publish_change('excel', *((schema.unit, schema.tipo) if schema else (None, None)), sheet=sheet)
+    return changed
+
+def cache_file_changed(unidad, tipo):
+    get_cache_writer().reload((unidad, tipo))
+    refresh_store_dpp([unidad], [tipo])
+    publish_change('dpp', unidad, tipo, version=read_cache_version(unidad, tipo))
+
+def _cache_stamp(unidad, tipo):
+    stamps = []
+    for path in (cache_path(unidad, tipo), cache_path(unidad, tipo, 'csv')):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stamps.append(None)
+        else:
+            stamps.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(stamps)
+
+class FileWatcher:
+    def __init__(self, file_path=EXCEL_FILE, mode=WATCH_MODE):
+        self.file_path = file_path
+        self.mode = mode
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._observer = None
+        self._workbook = None  # (versión, digests por hoja) de la última revisión
+        self._failed = None  # versión del libro que no se pudo leer
+        self._stamps = {}
+        self._thread = threading.Thread(target=self._run, name='watcher', daemon=True)
+
+    @property
+    def backend(self):
+        return 'poll' if self._observer is None else 'events'
+
+    def start(self):
+        if self.mode != 'poll':
+            self._observer = self._start_observer()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._observer is not None:
+            self._observer.stop()
+
+    def _start_observer(self):
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            return None
+        wake = self._wake
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.event_type not in WATCH_IGNORED_EVENTS:
+                    wake.set()
+
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        observer = Observer()
+        for path in {os.path.dirname(os.path.abspath(self.file_path)), os.path.abspath(CACHE_DIR)}:
+            observer.schedule(Handler(), path, recursive=False)
+        observer.daemon = True
+        try:
+            observer.start()
+        except OSError as e:  # p. ej. sin instancias de inotify disponibles
+            logging.warning("No se pudo vigilar con eventos del sistema (%s); se revisa periódicamente.", e)
+            return None
+        return observer
+
+    def _run(self):
+        interval = WATCH_POLL_INTERVAL if self._observer is None else WATCH_IDLE_INTERVAL
+        while not self._stop.is_set():
+            try:
+                self.check()
+            except Exception as e:
+                logging.warning("No se pudieron revisar los cambios en archivos: %s", e)
+            self._wake.wait(interval)
+            self._stop.wait(WATCH_SETTLE)
+            self._wake.clear()
+
+    def check(self):
+        self._check_workbook()
+        for key in get_schemas():
+            stamp = _cache_stamp(*key)
+            previous = self._stamps.get(key)
+            self._stamps[key] = stamp
+            if previous is not None and stamp != previous:
+                cache_file_changed(*key)
+
+    def _check_workbook(self):
+        try:
+            version = workbook_version(self.file_path)
+        except FileNotFoundError:
+            return  # reemplazo en curso
+        if version == self._failed or (self._workbook is not None and self._workbook[0] == version):
+            return
+        try:
+            digests = sheet_digests(*version)
+        except Exception as e:
+            # Archivo a medio escribir: se vuelve a intentar cuando cambie
+            logging.warning("No se pudo leer el libro '%s': %s", self.file_path, e)
+            self._failed = version
+            return
+        if self._workbook is not None:
+            workbook_replaced(*self._workbook, version, digests)
+        self._workbook = (version, digests)
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+def start_watcher(file_path=EXCEL_FILE):
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None and WATCH_MODE != 'off':
+            _watcher = FileWatcher(file_path)
+            _watcher.start()
+        return _watcher
+
+# Ajuste automático al Monto DPP 2025. Cada fórmula de Total es afín en cualquiera
+# de sus columnas de entrada: Total_i = base_i + pendiente_i * x_i. Ambos
+# vectores se obtienen evaluando la fórmula con la columna en 0 y en 1, y el
+# ajuste escala x proporcionalmente en las filas no bloqueadas. Con conteos
+# enteros se redondea hacia abajo y se reparten unidades por mayor resto.
+def linear_terms(df, schema, column):
+    inputs = df[list(schema.editable)].astype(float)
+    base = schema.compute_total(inputs.assign(**{column: 0.0}), decimals=None)
+    slope = schema.compute_total(inputs.assign(**{column: 1.0}), decimals=None) - base
+    return base, slope
+
+@metrics.timed('budget_fit')
+def solve_budget_fit(base, slope, x, target, locked=None, integer=False):
+    base, slope, x = (np.asarray(v, dtype=float) for v in (base, slope, x))
+    locked = np.zeros(len(x), dtype=bool) if locked is None else np.asarray(locked, dtype=bool)
+    free = ~locked & (slope != 0)
+    new_x = x.copy()
+    if not free.any():
+        return new_x
+
+    remaining = target - (base + slope * x)[~free].sum() - base[free].sum()
+    weight = (slope * x)[free].sum()
+    if weight > 0:
+        new_x[free] = x[free] * max(remaining / weight, 0.0)
+    else:
+        # Sin valores de partida se reparte el mismo valor en todas las filas libres
+        new_x[free] = max(remaining / slope[free].sum(), 0.0)
+    if remaining <= 0:
+        # Las filas bloqueadas ya superan el objetivo: las libres quedan en 0
+        return new_x
+
+    if integer:
+        # Se suma una unidad por mayor resto a cada fila que todavía entra en lo
+        # que falta, saltando las que no entran en lugar de detenerse en ellas
+        floor = np.floor(new_x[free])
+        free_slope = slope[free]
+        residual = remaining - (free_slope * floor).sum()
+        for i in np.argsort(-(new_x[free] - floor), kind='stable'):
+            if free_slope[i] <= residual + 1e-9:
+                floor[i] += 1
+                residual -= free_slope[i]
+        new_x[free] = floor
+    else:
+        # Corrige el redondeo a centavos en la fila de mayor pendiente
+        totals = np.round(base + slope * new_x, 2)
+        j = np.flatnonzero(free)[np.argmax(np.abs(slope[free]))]
+        new_x[j] = max(new_x[j] + (target - totals.sum()) / slope[j], 0.0)
+    return new_x
+
+# Motor de escenarios: cada escenario define factores por columna ('scale') y
+# tablas de valores por clave ('lookup', p. ej. per-diem por País). Para cada
+# hoja se arma una matriz escenarios x filas por columna de entrada y la
+# fórmula se evalúa una sola vez sobre todas; el resultado es la matriz de
+# totales escenario x unidad.
+SCENARIO_COLUMNS = ['Costo de Pasaje', 'Alojamiento', 'Per-diem y Otros', 'Movilidad', 'Monto mensual', 'Suma de MONTO']
+
+def scenario_row_totals(df, schema, scenarios):
+    formula = FORMULAS[schema.formula]
+    factors = {
+        col: np.array([scenario.get('scale', {}).get(col, 1.0) for scenario in scenarios], dtype=float)[:, None]
+        for col in formula['args']
+    }
+    inputs = []
+    for col in formula['args']:
+        values = df[col].to_numpy(dtype=float)[None, :] * factors[col]
+        for i, scenario in enumerate(scenarios):
+            lookup = scenario.get('lookup', {}).get(col)
+            if lookup is None or lookup[0] not in df.columns:
+                continue
+            key_col, table = lookup
+            mapped = df[key_col].map(table).to_numpy(dtype=float)
+            mask = ~np.isnan(mapped)
+            values[i, mask] = mapped[mask] * factors[col][i, 0]
+        inputs.append(values)
+    return formula['kernel'](*inputs)
+
+def scenario_matrix(frames, scenarios):
+    names = [scenario['name'] for scenario in scenarios]
+    totals = {
+        (schema.tipo, schema.unit): scenario_row_totals(df, schema, scenarios).sum(axis=1)
+        for schema, df in frames
+    }
+    matrix = pd.DataFrame(totals, index=pd.Index(names, name='Escenario'))
+    matrix.columns.names = ['Tipo', 'Unidad Organizacional']
+    return matrix
+
+def scenarios_from_tables(percentages, lookups):
+    scenarios = [{'name': 'Base'}]
+    for _, row in percentages.dropna(subset=['Escenario']).iterrows():
+        scale = {col: 1.0 + float(row[col]) / 100.0 for col in SCENARIO_COLUMNS if pd.notna(row.get(col)) and row[col] != 0}
+        lookup = {}
+        for _, entry in lookups[lookups['Escenario'] == row['Escenario']].dropna().iterrows():
+            lookup.setdefault('Per-diem y Otros', ('País', {}))[1][entry['País']] = float(entry['Per-diem'])
+        scenarios.append({'name': row['Escenario'], 'scale': scale, 'lookup': lookup})
+    return scenarios
@@ -0,0 +1,197 @@
+import os
+import io
+import json
+import time
+import bisect
+import cProfile
+import pstats
+import tempfile
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+# Instrumentación opcional de la app y del núcleo: tiempos por etapa (lectura
+# del libro, normalización, opciones de grilla, AgGrid, guardado, descarga...),
+# contadores de eventos y latencia de cada rerun por sesión, todo como
+# histogramas acumulados en el proceso. Se activa con PPT_PROFILING=1; apagada,
+# cada etapa cuesta solo la consulta de la bandera. Los datos se exportan en JSON
+# o en texto con el formato de Prometheus a METRICS_FILE para poder leerlos
+# desde fuera del proceso. Sin dependencias de streamlit, como ppt_core.
+METRICS_FILE = 'cache/metrics.prom'
+METRICS_JSON_FILE = 'cache/metrics.json'
+# Límites superiores de los buckets en segundos
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_TOP = 30
+
+_enabled = os.environ.get('PPT_PROFILING', '') not in ('', '0')
+
+def enabled():
+    return _enabled
+
+def set_enabled(flag):
+    global _enabled
+    _enabled = bool(flag)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # el último es +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # Aproximado por el límite del bucket donde cae el cuantil
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, n in zip((*self.buckets, self.max), self.counts):
+            seen += n
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count, 'sum': self.sum, 'max': self.max,
+            'p50': self.quantile(0.5), 'p95': self.quantile(0.95),
+            'buckets': dict(zip([*map(str, self.buckets), '+Inf'], self.counts)),
+        }
+
+_lock = threading.Lock()
+_stages = {}
+_counters = {}
+_reruns = {}
+
+def _observe(table, key, seconds):
+    with _lock:
+        hist = table.get(key)
+        if hist is None:
+            hist = table[key] = Histogram()
+        hist.observe(seconds)
+
+@contextmanager
+def stage(name):
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _observe(_stages, name, time.perf_counter() - start)
+
+def timed(name):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, n=1):
+    if _enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+def observe_rerun(session, seconds):
+    if _enabled:
+        _observe(_reruns, session, seconds)
+
+def reset():
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+        _reruns.clear()
+
+def snapshot():
+    with _lock:
+        return {
+            'stages': {name: hist.to_dict() for name, hist in _stages.items()},
+            'counters': dict(_counters),
+            'reruns': {session: hist.to_dict() for session, hist in _reruns.items()},
+        }
+
+def to_json(data=None):
+    return json.dumps(snapshot() if data is None else data, indent=2, ensure_ascii=False)
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _histogram_lines(metric, label, hists):
+    lines = [f"# TYPE {metric} histogram"]
+    for key, hist in sorted(hists.items()):
+        cumulative = 0
+        for bound, n in hist['buckets'].items():
+            cumulative += n
+            lines.append(f'{metric}_bucket{{{label}="{_label(key)}",le="{bound}"}} {cumulative}')
+        lines.append(f'{metric}_sum{{{label}="{_label(key)}"}} {hist["sum"]:.6f}')
+        lines.append(f'{metric}_count{{{label}="{_label(key)}"}} {hist["count"]}')
+    return lines
+
+def to_prometheus(data=None):
+    data = snapshot() if data is None else data
+    lines = _histogram_lines('ppt_stage_seconds', 'stage', data['stages'])
+    lines.append("# TYPE ppt_events_total counter")
+    lines += [f'ppt_events_total{{event="{_label(name)}"}} {n}' for name, n in sorted(data['counters'].items())]
+    lines += _histogram_lines('ppt_rerun_seconds', 'session', data['reruns'])
+    return "\n".join(lines) + "\n"
+
+def _write_text(path, text):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def write_metrics(path=METRICS_FILE, json_path=METRICS_JSON_FILE):
+    data = snapshot()
+    _write_text(path, to_prometheus(data))
+    if json_path:
+        _write_text(json_path, to_json(data))
+
+# Captura con cProfile de un bloque (por ejemplo, un rerun completo). Devuelve
+# el perfil para mostrarlo con profile_report o guardarlo con dump_stats. Desde
+# Python 3.12 solo puede haber un perfilador activo por proceso, así que las
+# capturas se serializan: si ya hay una en curso se devuelve None y el bloque
+# corre sin perfilar.
+_profile_lock = threading.Lock()
+
+@contextmanager
+def profiled():
+    if not _profile_lock.acquire(blocking=False):
+        count('profiles_skipped')
+        yield None
+        return
+    try:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # otra herramienta de perfilado ya está activa
+            count('profiles_skipped')
+            yield None
+            return
+        try:
+            yield profile
+        finally:
+            profile.disable()
+    finally:
+        _profile_lock.release()
+
+def profile_report(profile, limit=PROFILE_TOP, sort='cumulative'):
+    out = io.StringIO()
+    pstats.Stats(profile, stream=out).strip_dirs().sort_stats(sort).print_stats(limit)
+    return out.getvalue()
@@ -0,0 +1,20 @@
+import numpy as np
+
+from ppt_core import solve_budget_fit
+
+SLOPE = [100.0, 50.0, 10.0]
+BASE = [0.0, 0.0, 0.0]
+
+def test_locked_rows_over_target_leave_free_rows_at_zero():
+    x = solve_budget_fit(BASE, SLOPE, [5, 5, 5], 300, locked=[True, False, False])
+    np.testing.assert_array_equal(x, [5, 0, 0])
+
+def test_continuous_fit_hits_target_in_cents():
+    x = solve_budget_fit(BASE, SLOPE, [5, 5, 5], 1234)
+    assert (x >= 0).all()
+    assert np.round(np.asarray(SLOPE) * x, 2).sum() == 1234
+
+def test_integer_fit_skips_units_that_do_not_fit():
+    x = solve_budget_fit(BASE, SLOPE, [5, 5, 5], 1234, integer=True)
+    np.testing.assert_array_equal(x, np.round(x))
+    assert np.dot(SLOPE, x) == 1230
@@ -0,0 +1,56 @@
+import threading
+
+import pandas as pd
+import pytest
+
+import ppt_core
+from ppt_core import CacheWriter, load_versioned
+
+KEY = ('VPO', 'Consultorías')
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # Cache y almacén propios: rutas relativas y conexión SQLite nueva
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ppt_core, '_store_local', threading.local())
+    monkeypatch.setattr(ppt_core, '_cache_writer', None)
+    return tmp_path
+
+def excel_frame():
+    df = pd.DataFrame({'Nº': [1.0, 1.0, 1.0], 'Monto mensual': [100.0, 200.0, 300.0], 'cantidad meses': [2.0, 2.0, 2.0]})
+    df['Total'] = ppt_core.SCHEMAS[KEY].compute_total(df)
+    return df
+
+def edited(df, row, col, value):
+    df = df.copy()
+    df.loc[row, col] = value
+    df['Total'] = ppt_core.SCHEMAS[KEY].compute_total(df)
+    return df
+
+# Dos CacheWriter hacen de dos procesos que parten del libro sin archivo en disco
+def test_flush_merges_with_table_saved_by_other_process(workdir):
+    excel = excel_frame()
+    writer_a, writer_b = CacheWriter(delay=60), CacheWriter(delay=60)
+
+    writer_b.submit(KEY, edited(excel, 2, 'cantidad meses', 5.0), 0, excel)
+    writer_a.submit(KEY, edited(excel, 0, 'Nº', 9.0), 0, excel)
+    writer_a.flush_all()
+    writer_b.flush_all()
+
+    version, df = ppt_core._read_disk_frame(*KEY)
+    assert version == 2
+    assert df['Nº'].tolist() == [9.0, 1.0, 1.0]
+    assert df['cantidad meses'].tolist() == [2.0, 2.0, 5.0]
+    assert df['Total'].tolist() == [1800.0, 400.0, 1500.0]
+
+def test_first_write_without_other_process_keeps_session_table(workdir):
+    excel = excel_frame()
+    writer = CacheWriter(delay=60)
+    writer.submit(KEY, edited(excel, 1, 'Nº', 3.0), 0, excel)
+    writer.flush_all()
+
+    ppt_core._cache_writer = writer
+    version, df = load_versioned(*KEY)
+    assert version == 1
+    assert df['Nº'].tolist() == [1.0, 3.0, 1.0]
+    assert ppt_core.history_versions(*KEY)['version'].tolist() == [1]